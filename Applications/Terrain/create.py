@@ -4,31 +4,50 @@ import TerrainGenerator
 import WorldGenerator
 import MaterialGenerator
 import TextureGenerator
+import TerrainCache
 
 prefix         = ""
 avatar_prefix  = ""
 env_prefix     = ""
 
+cache = TerrainCache.TerrainCache("./cache")
+
+def create_terrain():
+    operations = [("fromFile", ("terrain.asc",), ()),
+                  ("adjustHeight", (-300.0,), ()),
+                  ("toFile", ("./terrain.ntf",), (("overwrite", True),)),
+                  ("toWeightmap", ("./terrainweight.png",), (("fileformat", "PNG"), ("overwrite", True), ("seed", 0)))]
+    outputs = ["./terrain.ntf", "./terrainweight.png"]
+    key = cache.key(["terrain.asc"], operations, [TerrainGenerator])
+    if cache.fetch(key, outputs) == True:
+        print "Terrain and weightmap found from the cache"
+        return
+    print "Reading terrain from ASC file and generating weightmap for it"
+    if cache.run(TerrainGenerator.TerrainGenerator(), operations) == True:
+        cache.store(key, outputs)
+
+def create_textures():
+    colors = [("./grass.png", (30,100,30,50)), ("./rock.png", (90,83,73,50)), ("./sand.png", (160,136,88,70))]
+    operations = [("createSingleColorTexture",) + color for filename, color in colors]
+    outputs = [filename for filename, color in colors]
+    key = cache.key([], operations, [TextureGenerator])
+    if cache.fetch(key, outputs) == True:
+        print "Terrain textures found from the cache"
+        return
+    print "Generating terrain textures"
+    t = TextureGenerator.TextureGenerator()
+    for filename, color in colors:
+        t.createSingleColorTexture(*color)
+        t.toImage(filename, "PNG", overwrite=True)
+    cache.store(key, outputs)
+
 def create_assets():
-    print "Reading terrain from ASC file"
-    t = TerrainGenerator.TerrainGenerator()
-    t.fromFile("terrain.asc")
-    t.adjustHeight(-300.0)
-    t.toFile("./terrain.ntf", overwrite=True)
-    print "Generating weightmap for the ASC terrain"
-    t.toWeightmap("./terrainweight.png", fileformat="PNG", overwrite=True)
+    create_terrain()
     print "Generating terrain material"
     m = MaterialGenerator.Material("terrain")
     m.createMaterial_4channelTerrain("terrain", "sand.png", "grass.png", "rock.png", "", "terrainweight.png")
     m.toFile("./terrain.material", overwrite=True)
-    print "Generating terrain textures"
-    t = TextureGenerator.TextureGenerator()
-    t.createSingleColorTexture(30,100,30,50)
-    t.toImage("./grass.png", "PNG", overwrite=True)
-    t.createSingleColorTexture(90,83,73,50)
-    t.toImage("./rock.png", "PNG", overwrite=True)
-    t.createSingleColorTexture(160,136,88,70)
-    t.toImage("./sand.png", "PNG", overwrite=True)
+    create_textures()
 
 def create_world():
     t_width  = 16*((1500/16)+1)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+#
+# Author: Jarkko Vatjus-Anttila <jvatjusanttila@gmail.com>
+#
+# For conditions of distribution and use, see copyright notice in license.txt
+#
+
+import sys, os
+import hashlib
+import shutil
+import tempfile
+
+class TerrainCache():
+    """ class TerrainCache():
+        - TerrainCache is an on-disk store for files produced by the generators, such as NTF
+          terrains, weightmaps and textures. Generating them again is skipped when the inputs
+          have not changed.
+        - Results are stored under a key, which is a hash of the bytes of the source files, of
+          the source code of the generator modules, and of the full ordered list of operations
+          and their parameters, including the seeds. When the key is found from the cache, the
+          stored files are copied to their places and the whole chain of operations can be
+          skipped. Running the operations from the same list they are hashed from keeps the
+          key in line with what was really done:
+
+            operations = [("fromFile", ("terrain.asc",), ()),
+                          ("adjustHeight", (-300.0,), ()),
+                          ("toFile", ("terrain.ntf",), (("overwrite", True),))]
+            key = cache.key(["terrain.asc"], operations, [TerrainGenerator])
+            if cache.fetch(key, ["terrain.ntf"]) == False:
+                cache.run(TerrainGenerator.TerrainGenerator(), operations)
+                cache.store(key, ["terrain.ntf"])
+
+        - The cache is kept below maxsize bytes by removing the least recently used entries.
+    """
+
+    def __init__(self, directory=".terraincache", maxsize=1<<30):
+        """ TerrainCache.__init__(directory, maxsize):
+            - Initializes the cache in directory, which is created if it does not exist.
+            Return value: None
+        """
+        self.directory = directory
+        self.maxsize = maxsize
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+#############################################################################
+# Cache textual output methods
+#
+
+    def printmessage(self, message):
+        sys.stdout.write(message + "\n")
+
+    def printerror(self, message):
+        sys.stderr.write("ERROR: " + str(message) + "\n")
+
+#############################################################################
+# Cache access methods
+#
+
+    def key(self, sources, operations, modules=[]):
+        """ TerrainCache.key(sources, operations, modules)
+            - key() hashes the contents of the source files, the source code of the modules and
+              the operations into a cache key.
+            - operations is a list of operation names and parameters, typically tuples. Their
+              order matters, and their repr() needs to be the same from run to run, which is the
+              case for strings, numbers, tuples and lists of them.
+            - modules are the generator modules which run the operations. Any change in their
+              source code changes the key, so results of an older generator are not reused.
+            Return value: hexadecimal key string, or None if a source file could not be read
+        """
+        digest = hashlib.sha256()
+        filenames = list(sources)
+        for module in modules:
+            filenames.append(os.path.splitext(module.__file__)[0] + ".py")
+        for filename in filenames:
+            try: f = open(filename, "rb")
+            except IOError:
+                self.printerror("Cache source file " + str(filename) + " could not be read.")
+                return None
+            digest.update("%d\n" % os.fstat(f.fileno()).st_size)
+            while True:
+                data = f.read(1<<20)
+                if not data: break
+                digest.update(data)
+            f.close()
+        digest.update(repr(list(operations)))
+        return digest.hexdigest()
+
+    def run(self, target, operations):
+        """ TerrainCache.run(target, operations)
+            - run() calls the methods of target listed in operations, in order. Each operation is
+              a (name, args, kwargs) tuple, where kwargs is a tuple of (keyword, value) pairs, so
+              that the same list can be given to key().
+            Return value: True if all the methods succeeded, otherwise False
+        """
+        for name, args, kwargs in operations:
+            if getattr(target, name)(*args, **dict(kwargs)) == False:
+                self.printerror("Cached operation " + str(name) + " failed.")
+                return False
+        return True
+
+    def fetch(self, key, outputs):
+        """ TerrainCache.fetch(key, outputs)
+            - fetch() copies the files stored under key into the paths listed in outputs,
+              overwriting them, and marks the entry as the most recently used.
+            Return value: True if the key was found, otherwise False
+        """
+        if key == None:
+            return False
+        entry = os.path.join(self.directory, key)
+        stored = [os.path.join(entry, str(k)) for k in range(len(outputs))]
+        if not all(os.path.isfile(filename) for filename in stored):
+            return False
+        for source, target in zip(stored, outputs):
+            shutil.copyfile(source, target)
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, outputs):
+        """ TerrainCache.store(key, outputs)
+            - store() copies the files listed in outputs into the cache under key, and then
+              evicts the least recently used entries, if the cache has grown above maxsize.
+            Return value: True if success, otherwise False
+        """
+        if key == None:
+            return False
+        entry = os.path.join(self.directory, key)
+        # The entry is filled in a temporary directory and renamed in place, so that a
+        # partially written entry is never found by fetch()
+        partial = tempfile.mkdtemp(dir=self.directory, prefix=".")
+        try:
+            for k, filename in enumerate(outputs):
+                shutil.copyfile(filename, os.path.join(partial, str(k)))
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(partial, entry)
+        except (IOError, OSError), e:
+            shutil.rmtree(partial, ignore_errors=True)
+            self.printerror("Storing cache entry " + str(key) + " failed: " + str(e))
+            return False
+        self.evict(keep=key)
+        return True
+
+    def evict(self, keep=None):
+        """ TerrainCache.evict(keep)
+            - evict() removes the least recently used entries until the cache fits in maxsize.
+              The entry keep is never removed.
+            Return value: number of removed entries
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, name))
+            total += size
+        removed = 0
+        for used, size, name in sorted(entries):
+            if total <= self.maxsize:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
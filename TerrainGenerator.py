@@ -6,12 +6,14 @@
 #
 
 import sys, os, io
-import array
+import time
+import inspect
+import tempfile
+import multiprocessing
 import random
 import numpy
 from math import *
 from PIL import Image
-from noise import pnoise2
 
 class TerrainGenerator():
     """ class TerrainGenerator():
@@ -23,20 +25,61 @@ class TerrainGenerator():
           can be of anything that Python Imaging Library supports. Image is treated as
           heightmap based on pixel color and the information is used to directly feed
           height information into float matrix.
-        - Dependencies are Python Imaging Library (PIL), array module and NumPy
+        - Dependencies are Python Imaging Library (PIL) and NumPy
     """
 
-    def __init__(self, width=16, height=16):
-        """ TerrainGenerator.__init__(width, height):
+    def __init__(self, width=16, height=16, tiled=None, tilesize=1024, tiledir=None, processes=1, lazy=False, dtype=numpy.float32):
+        """ TerrainGenerator.__init__(width, height, tiled, tilesize, tiledir, processes, lazy, dtype):
             - Initializes the class and makes reservation for the terrain table.
             - cPatchSize is fixed to 16, as the same hardcoding is used within Tundra. This
               script works with other patch sizes as well, but resulted output is no longer
               supported by Tundra. Hence, it is recommended to leave the value fixed.
+            - Terrains larger than tiledThreshold samples are kept in a disk-backed table in
+              tiledir (system temp directory if None) instead of memory. Neighbourhood algorithms
+              then process them in tiles of tilesize*tilesize samples, with a halo border of
+              tileHalo samples (None picks the halo which gives seamless results). tiled=True
+              or tiled=False forces the choice regardless of the size.
+            - With processes above 1, noise, the elementwise manipulators, smoothen and erosion
+              of in-memory terrains run in a pool of that many worker processes. The terrain is
+              moved into shared memory and split into bands of rows. Results equal the ones of a
+              single process, bit for bit. The pool is started on first use and kept for later
+              algorithms until close() is called. toWeightmap() stays in the calling process: its
+              thresholds are jittered from one sequential random stream, which cannot be split
+              into bands without changing the image, and the drawing is most of its work.
+            - With lazy=True the elementwise manipulators (rescale, adjustHeight, quantize and
+              saturate) are only recorded. Consecutive ones are then run together in a single pass
+              over the terrain, block by block, when the heights are needed or compute() is called.
+            - dtype is the type of the stored heights. NTF files hold float32, so float32 tables
+              take half the memory of float64 ones. The algorithms compute in float64 and round
+              into the table once, so each of them alone writes exactly the NTF the float64 table
+              would give. Chains of algorithms round the table in between. That usually changes
+              the last bit only, but quantize() is not continuous: a height which the rounding
+              moves over a level boundary lands a whole level away. Lazy manipulators run fused
+              from the stored heights and round once, so a lazy chain of them writes the same NTF
+              with both types. Running this module standalone compares the NTF output of both
+              types and reports the differences.
+            - worldOrigin and worldSize place the terrain into a larger world, see toWorldTiles().
+              Noise is then evaluated at world coordinates, scaled to the world size.
             Return value: None
         """
         self.cPatchSize = 16
+        self.tiled = tiled
+        self.tiledThreshold = 1<<26
+        self.tilesize = tilesize
+        self.tileHalo = None
+        self.tiledir = tiledir
+        self.processes = processes
+        self.lazy = lazy
+        self.dtype = numpy.dtype(dtype)
+        self.worldOrigin = (0, 0)
+        self.worldSize = None
+        self.r_pool = None
+        self.r_tables = []
         self.initialize(width, height)
 
+    def __del__(self):
+        self.close()
+
     def initialize(self, width=16, height=16):
         """ TerrainGenerator.initialize(width, height):
             - Makes memory allocation for the terrain table. Default size for the table is
@@ -54,9 +97,43 @@ class TerrainGenerator():
         self.maxitem = 0
         self.maxvalid = False
         self.minvalid = False
-        self.d_array = numpy.zeros([width*self.cPatchSize+1,height*self.cPatchSize+1], dtype=float)
+        self.p_array = None
+        self.v_array = None
+        self.l_array = None
+        self.pending = []
+        self.s_array = None
+        self.r_shared = None
+        self.r_spare = None
+        self.m_array = None
+        self.cellsize = 1.0
+        self.xllcorner = 0.0
+        self.yllcorner = 0.0
+        self.d_array = self.__allocate([width*self.cPatchSize+1,height*self.cPatchSize+1])
         return True
 
+    def __getattr__(self, name):
+        """ TerrainGenerator.__getattr__(name)
+            - When the terrain is memory-mapped from an NTF file, d_array is not loaded until some
+              algorithm needs the full table. The first access materializes it from the map.
+            - Likewise after crop() and mirror() the terrain is a read-only view of the old table,
+              which is copied into a new d_array when an algorithm needs to modify it.
+            - In lazy mode, the table waits in l_array while elementwise manipulators are pending,
+              and accessing d_array runs them first.
+        """
+        if name == "d_array" and self.__dict__.get("l_array") is not None:
+            self.compute()
+            return self.d_array
+        if name == "d_array" and self.__dict__.get("v_array") is not None:
+            self.d_array = self.__allocate([self.width*self.cPatchSize+1,self.height*self.cPatchSize+1])
+            self.d_array[:self.width*self.cPatchSize, :self.height*self.cPatchSize] = self.v_array
+            self.v_array = None
+            return self.d_array
+        if name == "d_array" and self.__dict__.get("p_array") is not None:
+            self.d_array = self.__allocate([self.width*self.cPatchSize+1,self.height*self.cPatchSize+1])
+            self.d_array[:self.width*self.cPatchSize, :self.height*self.cPatchSize] = self.__patchesToTable(self.p_array)
+            return self.d_array
+        raise AttributeError(name)
+
 #############################################################################
 # Terrain textual output methods
 #
@@ -71,165 +148,755 @@ class TerrainGenerator():
 # Terrain file manipulators
 #
 
-    def fromFile(self, filename):
+    def fromFile(self, filename, byteorder=None, mapped=False, writable=False, fill=None, cellsize=None, origin=None):
         if filename.endswith(".ntf"):
-            return self.__fromNTFFile(filename)
+            if mapped == True:
+                return self.__mapNTFFile(filename, byteorder, writable)
+            return self.__fromNTFFile(filename, byteorder)
         if filename.endswith(".asc"):
-            return self.__fromASCFile(filename)
+            if fill == None: fill = "zero"
+            return self.__fromASCFile(filename, fill)
         if filename.endswith(".xyz"):
-            return self.__fromXYZFile(filename)
+            if fill == None: fill = "nearest"
+            return self.__fromXYZFile(filename, fill, cellsize, origin)
         return False
 
-    def __fromNTFFile(self, filename):
-        """ TerrainGenerator.__fromNTFFile(filename)
+    def __fromNTFFile(self, filename, byteorder=None):
+        """ TerrainGenerator.__fromNTFFile(filename, byteorder)
             - Loads a terrain definition from NTF file into internal table. File can then be further
               processed, with TerrainGenerator internal methods, or directly manipulating
               self.d_array table.
+            - The file is read in blocks of patch rows. The patch-major ordering of each block is
+              converted into the internal table with a single reshape/transpose, so a disk-backed
+              terrain is never held in memory as a whole.
+            - byteorder is either "<" (little-endian, as written by Tundra), ">" (big-endian) or
+              None, in which case the byteorder is detected from the header and the file size.
               Return value: True if file input succeeded, otherwise False
         """
         try: f = open(filename, "rb")
         except IOError: self.printerror("Requested file " + str(filename) + " does not exist."); return False
 
-        size_buf = array.array("I")
-        size_buf.fromfile(f, 2)
-        l = size_buf.tolist()
-        self.initialize(l[0], l[1])
-        for i in range(self.width):
-            for j in range(self.height):
-                d_buf = array.array("f")
-                d_buf.fromfile(f, self.cPatchSize*self.cPatchSize)
-                l = d_buf.tolist()
-                for x in range(self.cPatchSize):
-                    for y in range(self.cPatchSize):
-                        self.d_array[i*self.cPatchSize+x][j*self.cPatchSize+y] = l[x*self.cPatchSize+y]
+        f.seek(0, os.SEEK_END)
+        filesize = f.tell()
+        f.seek(0)
+        if byteorder == None:
+            byteorder = self.__detectNTFByteorder(f.read(8), filesize)
+            if byteorder == None:
+                f.close()
+                self.printerror("File " + str(filename) + " is not a valid NTF file.")
+                return False
+            f.seek(0)
+
+        header = numpy.fromfile(f, dtype=byteorder+"u4", count=2)
+        if len(header) != 2:
+            f.close()
+            self.printerror("File " + str(filename) + " is not a valid NTF file.")
+            return False
+        width, height = int(header[0]), int(header[1])
+        patchrow = height*self.cPatchSize*self.cPatchSize
+        if 8 + width*patchrow*4 > filesize:
+            f.close()
+            self.printerror("File " + str(filename) + " is truncated.")
+            return False
+
+        self.initialize(width, height)
+        for start, stop in self.__rowBlocks(width, patchrow):
+            d_buf = numpy.fromfile(f, dtype=byteorder+"f4", count=(stop-start)*patchrow)
+            self.d_array[start*self.cPatchSize:stop*self.cPatchSize, :height*self.cPatchSize] = \
+                self.__patchesToTable(d_buf.reshape(stop-start, height, self.cPatchSize, self.cPatchSize))
         f.close()
         self.minvalid = False
         self.maxvalid = False
         return True
-        
-    def __fromXYZFile(self, filename):
-        with open(filename) as f:
-            for i, l in enumerate(f): pass
 
-        inputWidth = int(sqrt(i+1))
-        totalWidth = ((inputWidth/self.cPatchSize)+1)*self.cPatchSize
-        patches = totalWidth/self.cPatchSize
-        #print "lines ", i+1, inputWidth, totalWidth, patches
+    def __mapNTFFile(self, filename, byteorder=None, writable=False):
+        """ TerrainGenerator.__mapNTFFile(filename, byteorder, writable)
+            - Memory-maps an NTF file instead of loading it. The file is exposed in self.p_array as a
+              (width, height, cPatchSize, cPatchSize) float32 view, which the OS pages in lazily.
+              getPatch() and getHeight() read only the pages they need, and if the map is writable,
+              setPatch() edits the file in place. flush() commits the edits to disk.
+            - self.d_array is materialized from the map only when an algorithm accesses it.
+              Return value: True if file mapping succeeded, otherwise False
+        """
+        try: f = open(filename, "rb")
+        except IOError: self.printerror("Requested file " + str(filename) + " does not exist."); return False
+        header = f.read(8)
+        f.seek(0, os.SEEK_END)
+        filesize = f.tell()
+        f.close()
+        if len(header) != 8:
+            self.printerror("File " + str(filename) + " is not a valid NTF file.")
+            return False
+        if byteorder == None:
+            byteorder = self.__detectNTFByteorder(header, filesize)
+            if byteorder == None:
+                self.printerror("File " + str(filename) + " is not a valid NTF file.")
+                return False
+        width, height = numpy.frombuffer(header, dtype=byteorder+"u4")
+        width, height = int(width), int(height)
+        if 8 + width*height*self.cPatchSize*self.cPatchSize*4 > filesize:
+            self.printerror("File " + str(filename) + " is truncated.")
+            return False
 
-        # Setup the terrain
-        self.initialize(patches, patches)
+        self.initialize(0, 0)
+        self.width = width
+        self.height = height
+        del self.d_array
+        if writable == True: mode = "r+"
+        else: mode = "r"
+        self.p_array = numpy.memmap(filename, dtype=byteorder+"f4", mode=mode, offset=8,
+                                    shape=(width, height, self.cPatchSize, self.cPatchSize))
+        return True
 
-        f = open(filename)
-        x = 0
-        y = 0
-        while 1:
-            line = f.readline()
-            if len(line) == 0: return
-            value = line.strip().split(" ")[2]
-            #print x, y, value
-            self.d_array[x][y] = value
-            x += 1
-            if x == inputWidth:
-                for a in range(x, totalWidth):
-                    #print " ", a, y, value
-                    self.d_array[a][y] = value
-                x = 0
-                y += 1
-                if y == inputWidth:
-                    for b in range(y, totalWidth):
-                        for a in range(totalWidth):
-                            #print "  ", a, b, value
-                            self.d_array[a][b] = value
-                    break
+    def flush(self):
+        """ TerrainGenerator.flush()
+            - Commits the changes of a writable memory-mapped terrain back to its NTF file. If the
+              full table has been materialized, only the patches which differ from the file are
+              copied back into the map, so unchanged parts of the file are not rewritten.
+            Return value: True if success, False if the terrain is not a writable map
+        """
+        if self.p_array is None or self.p_array.flags.writeable == False:
+            self.printerror("flush() requires a writable memory-mapped terrain.")
+            return False
+        if not self.__isMapped():
+            if (self.width, self.height) != self.p_array.shape[:2]:
+                self.printerror("flush() terrain dimensions no longer match the mapped file.")
+                return False
+            patches = self.__tableToPatches(self.__view())
+            changed = (patches != self.p_array).any(axis=3).any(axis=2)
+            for i, j in zip(*numpy.nonzero(changed)):
+                self.p_array[i, j] = patches[i, j]
+        self.p_array.flush()
+        return True
+
+    def __fromXYZFile(self, filename, fill="nearest", cellsize=None, origin=None):
+        """ TerrainGenerator.__fromXYZFile(filename, fill, cellsize, origin)
+            - Imports a point cloud of "x y z" lines, for example an XYZ export of laser scanned
+              elevation. The file is parsed in a single pass, in large blocks.
+            - Points are binned into cells of cellsize units, counted from origin, the (x, y) centre
+              of the first cell. X runs along the first axis of the table and Y from north to south
+              along the second axis, as with ASC files. If not given, origin is the west and north
+              extreme of the points and cellsize is estimated with __pointSpacing(). The estimates
+              need all points in memory, while with both given each block is binned as it is parsed.
+            - Cells hit by several points get their average. Cells without points are marked True
+              in self.m_array and filled according to fill, see __fromASCFile().
+            - Grids of far more cells than points, typically from a too small cellsize or from
+              outlier points, are refused.
+              Return value: True if file input succeeded, otherwise False
+        """
+        try: f = open(filename, "r")
+        except IOError: self.printerror("Requested file %s does not exist." % filename); return False
+
+        first = f.readline()
+        columns = len(first.split())
+        if columns < 3:
+            f.close()
+            self.printerror("File %s is not a valid XYZ file." % filename)
+            return False
+        blocks = self.__parseBlocks(f, first, dtype=float)
+        if cellsize == None or origin == None:
+            data = numpy.concatenate(list(blocks))
+            if len(data) == 0 or len(data) % columns != 0:
+                f.close()
+                self.printerror("File %s is not a valid XYZ file." % filename)
+                return False
+            points = data.reshape(-1, columns)
+            if cellsize == None:
+                cellsize = self.__pointSpacing(points[:, 0], points[:, 1])
+            if origin == None:
+                origin = (float(points[:, 0].min()), float(points[:, 1].max()))
+            blocks = [data]
+
+        # grid holds the hit counts and height sums of the cells, the point count and the extent
+        grid = [numpy.zeros((0, 0)), numpy.zeros((0, 0)), 0, 0, 0]
+        carry = numpy.zeros(0)
+        for block in blocks:
+            if len(carry) > 0:
+                block = numpy.concatenate((carry, block))
+            usable = len(block) - len(block) % columns
+            carry = block[usable:]
+            if self.__binPoints(block[:usable].reshape(-1, columns), cellsize, origin, grid) == False:
+                f.close()
+                self.printerror("File %s needs a grid of more than %d*%d cells for %d points. "
+                                "Give a larger cellsize, or an origin near the points." % ((filename,) + tuple(grid[3:5]) + (grid[2],)))
+                return False
+        f.close()
+        if len(carry) > 0 or grid[2] == 0:
+            self.printerror("File %s is not a valid XYZ file." % filename)
+            return False
+        cols, rows = grid[3], grid[4]
+        if cols == 0:
+            self.printerror("File %s has no points after the origin." % filename)
+            return False
+
+        hits = grid[0][:cols, :rows]
+        table = grid[1][:cols, :rows]
+        mask = (hits == 0)
+        numpy.true_divide(table, numpy.maximum(hits, 1), out=table)
+        return self.__fromTable(table, mask, fill, cellsize, origin[0] - cellsize/2.0,
+                                origin[1] - (rows-0.5)*cellsize)
+
+    def __binPoints(self, points, cellsize, origin, grid):
+        """ TerrainGenerator.__binPoints(points, cellsize, origin, grid)
+            - Accumulates (n, 3+) points into the cell counts and height sums of grid, see
+              __fromXYZFile(). The tables grow as points beyond them arrive.
+            Return value: True if success, False if the grid would grow too large
+        """
+        grid[2] += len(points)
+        ix = numpy.rint((points[:, 0] - origin[0]) / cellsize).astype(numpy.int64)
+        iy = numpy.rint((origin[1] - points[:, 1]) / cellsize).astype(numpy.int64)
+        inside = (ix >= 0) & (iy >= 0)
+        ix = ix[inside]; iy = iy[inside]; z = points[inside, 2]
+        if len(z) == 0:
+            return True
+        cols = max(grid[3], int(ix.max()) + 1)
+        rows = max(grid[4], int(iy.max()) + 1)
+        grid[3], grid[4] = cols, rows
+        if cols*rows > max(64*grid[2], 1<<22):
+            return False
+        hits, sums = grid[0], grid[1]
+        if cols > hits.shape[0] or rows > hits.shape[1]:
+            # Grow geometrically so that point clouds extending block by block copy little
+            shape = (max(cols, min(2*hits.shape[0], 2*cols)), max(rows, min(2*hits.shape[1], 2*rows)))
+            grid[0] = hits = numpy.pad(hits, ((0, shape[0]-hits.shape[0]), (0, shape[1]-hits.shape[1])), mode="constant")
+            grid[1] = sums = numpy.pad(sums, ((0, shape[0]-sums.shape[0]), (0, shape[1]-sums.shape[1])), mode="constant")
+        cell = ix*hits.shape[1] + iy
+        hits += numpy.bincount(cell, minlength=hits.size).reshape(hits.shape)
+        sums += numpy.bincount(cell, weights=z, minlength=sums.size).reshape(sums.shape)
         return True
 
-    def __fromASCFile(self, filename):
-        """ TerrainGenerator.__fromASCFile(filename)
+    def __pointSpacing(self, x, y):
+        """ TerrainGenerator.__pointSpacing(x, y)
+            - Estimates the cellsize of a point cloud. Gridded points give their median spacing
+              along X, which stray points do not change. Scattered points give the spacing of their
+              density, with the area taken between the 1st and 99th percentiles against outliers.
+            Return value: cellsize
+        """
+        spacing = numpy.diff(numpy.unique(x))
+        spacing = spacing[spacing > 0]
+        median = 0.0
+        if len(spacing) > 0:
+            median = float(numpy.median(spacing))
+        x0, x1 = numpy.percentile(x, [1, 99])
+        y0, y1 = numpy.percentile(y, [1, 99])
+        inside = numpy.count_nonzero((x >= x0) & (x <= x1) & (y >= y0) & (y <= y1))
+        density = 0.0
+        if inside > 0:
+            density = sqrt((x1-x0)*(y1-y0) / inside)
+        cellsize = max(median, density)
+        if cellsize <= 0.0:
+            return 1.0
+        return cellsize
+
+    def __fromASCFile(self, filename, fill="zero"):
+        """ TerrainGenerator.__fromASCFile(filename, fill)
               Return value: True if file input succeeded, otherwise False
               ASC fileformat is delivered by Maanmittauslaitos in Finland. Their height
               data is directly convertable into Tundra NTF format. This import code
               is a bridge for that.
+            - The header is parsed into self.cellsize, self.xllcorner and self.yllcorner. The
+              values are streamed in large blocks into a preallocated float32 table.
+            - Cells with the NODATA_value are marked True in self.m_array, which has the shape of
+              the terrain, and filled according to fill: "zero" sets them to zero, "nearest" copies
+              the nearest valid cells and "edge" extends the closest valid value above the cell in
+              the file (or below, for gaps at the top).
+            - Terrain size is rounded up to full patches, plus one patch, and the extra area is
+              filled by extending the last column and row.
         """
         try: f = open(filename, "r")
         except IOError: self.printerror("Requested file %s does not exist." % filename); return False
 
-        # first read the header
-        line = f.readline()
-        cols = int(line.split(" ")[-1].strip())
-        line = f.readline()
-        rows = int(line.split(" ")[-1].strip())
-        f.readline()
-        f.readline()
-        f.readline()
-        line = f.readline()
-        novalue = float(line.split(" ")[-1].strip())
+        header, first = self.__readASCHeader(f)
+        if header == None:
+            f.close()
+            self.printerror("File %s has no valid ASC header." % filename)
+            return False
+        cols = header["ncols"]
+        rows = header["nrows"]
+
+        values = numpy.empty(rows*cols, dtype=numpy.float32)
+        count = self.__parseValues(f, first, values)
+        f.close()
+        if count != rows*cols:
+            self.printerror("File %s has %d values, expected %d." % (filename, count, rows*cols))
+            return False
+        values = values.reshape(rows, cols)
 
-        if rows != cols:
-            print "Warning: Importing ASCII data which is not square shaped!"
+        # File rows run along the second axis of the table
+        table = values.T
+        mask = None
+        if "nodata_value" in header:
+            mask = (table == header["nodata_value"])
+        return self.__fromTable(table, mask, fill, header["cellsize"], header["xllcorner"], header["yllcorner"])
+
+    def __fromTable(self, table, mask, fill, cellsize, xllcorner, yllcorner):
+        """ TerrainGenerator.__fromTable(table, mask, fill, cellsize, xllcorner, yllcorner)
+            - Sets up the terrain from a (cols, rows) table of imported heights. Cells marked in mask
+              are filled according to fill and recorded in self.m_array.
+            - Terrain size is rounded up to full patches, plus one patch, and the extra area is
+              filled by extending the last column and row.
+            Return value: True if success, otherwise False
+        """
+        cols, rows = table.shape
+        if mask is not None and mask.any():
+            if self.__fillNodata(table, mask, fill) == False:
+                return False
+        else:
+            mask = None
 
         # Setup the terrain
-        self.initialize(((rows/self.cPatchSize)+1), ((cols/self.cPatchSize)+1))
+        self.initialize(((cols/self.cPatchSize)+1), ((rows/self.cPatchSize)+1))
+        self.cellsize = cellsize
+        self.xllcorner = xllcorner
+        self.yllcorner = yllcorner
+        self.d_array[:cols, :rows] = table
+        self.__padTable(cols, rows, mask)
+        return True
+
+    def __padTable(self, cols, rows, mask):
+        """ TerrainGenerator.__padTable(cols, rows, mask)
+            - Fills the row and column ends of the terrain beyond the imported cols*rows cells, by
+              extending the last column and row, and records the nodata mask into self.m_array.
+            Return value: None
+        """
+        w = self.width*self.cPatchSize
+        h = self.height*self.cPatchSize
+        self.d_array[cols:w, :rows] = self.d_array[cols-1, :rows]
+        self.d_array[:w, rows:h] = self.d_array[:w, rows-1:rows]
+        if mask is not None:
+            self.m_array = numpy.zeros([w, h], dtype=bool)
+            self.m_array[:cols, :rows] = mask
 
-        # Then loop through the file
-        currentRow = 0
-        currentCol = 0
+    def __readASCHeader(self, f):
+        """ TerrainGenerator.__readASCHeader(f)
+            - Reads the "key value" header lines of an ASC file. Keys are case insensitive and may
+              come in any order. The header ends at the first line starting with a number.
+            - xllcenter/yllcenter are converted into corner coordinates.
+            Return value: tuple of header dictionary (None if invalid) and the first data line
+        """
+        header = {}
         while 1:
             line = f.readline()
             if len(line) == 0: break
-            t = line.split(" ")                     # t contains a row of terrain patch values
-            #print len(t)
-            for c in range(len(t)-1):               # Last mark is linefeed, that is why -1
-                value = float(t[c])
-                if value == novalue: print "novalue"; value = 0.0    # Using zero for non-defined values
-                self.d_array[currentRow][currentCol] = value
-                currentRow += 1
-                if currentRow == cols:
-                    # fill the row-ends of the terrain, if its size is not power of 2
-                    for i in range((cols/self.cPatchSize+1)*self.cPatchSize - currentRow):
-                        #print "filling row: ", currentRow, currentCol, "with ", value
-                        self.d_array[currentRow][currentCol] = value
-                        currentRow += 1
-                    currentRow = 0
-                    currentCol += 1
-                    if currentCol == rows:
-                        # fill the column-ends of the terrain, if its size is not power of 2
-                        for col in range(currentCol, (cols/self.cPatchSize+1)*self.cPatchSize):
-                            for row in range((rows/self.cPatchSize+1)*self.cPatchSize):
-                                #print "filling col:", row, col, "from", row, cols-1, "with value ", self.d_array[row][cols-1]
-                                self.d_array[row][col] = self.d_array[row][cols-1]
-                            #currentCol += 1
-                        break                       # End of table reached
+            t = line.split()
+            if len(t) == 0: continue
+            try:
+                float(t[0])
+                break
+            except ValueError: pass
+            if len(t) != 2: return None, ""
+            header[t[0].lower()] = t[1]
+        try:
+            result = { "ncols":int(header["ncols"]), "nrows":int(header["nrows"]),
+                       "cellsize":float(header.get("cellsize", 1.0)) }
+            for axis in ("x", "y"):
+                if axis+"llcorner" in header:
+                    result[axis+"llcorner"] = float(header[axis+"llcorner"])
+                else:
+                    result[axis+"llcorner"] = float(header.get(axis+"llcenter", 0.0)) - result["cellsize"]/2.0
+            if "nodata_value" in header:
+                result["nodata_value"] = float(header["nodata_value"])
+        except (KeyError, ValueError):
+            return None, ""
+        return result, line
+
+    def __parseValues(self, f, text, values):
+        """ TerrainGenerator.__parseValues(f, text, values)
+            - Parses whitespace separated numbers from text and then from the rest of file f into
+              the preallocated array values, block by block.
+            Return value: number of parsed values
+        """
+        count = 0
+        for parsed in self.__parseBlocks(f, text, values.dtype):
+            n = min(len(parsed), len(values)-count)
+            values[count:count+n] = parsed[:n]
+            count += n
+            if count == len(values): break
+        return count
+
+    def __parseBlocks(self, f, text="", dtype=float, blocksize=1<<24):
+        """ TerrainGenerator.__parseBlocks(f, text, dtype, blocksize)
+            - Generator which parses whitespace separated numbers from text and then from the rest of
+              file f. The file is read in blocks of blocksize bytes and a number cut by the block
+              border is carried over to the next block.
+            Return value: yields one array of numbers per block
+        """
+        while 1:
+            block = f.read(blocksize)
+            if len(block) == 0:
+                tail = ""
+            else:
+                cut = max(block.rfind(" "), block.rfind("\n"), block.rfind("\r"), block.rfind("\t"))
+                if cut < 0:
+                    text += block
+                    continue
+                tail = block[cut+1:]
+                text += block[:cut+1]
+            yield numpy.fromstring(text, dtype=dtype, sep=" ")
+            text = tail
+            if len(block) == 0: break
+
+    def __fillNodata(self, table, mask, fill):
+        """ TerrainGenerator.__fillNodata(table, mask, fill)
+            - Fills the cells of table marked in mask. "zero" writes zeros, "edge" extends the last
+              valid value along the second axis and "nearest" grows the valid area one cell at a time
+              from its four neighbours until the table is full. Each step of "nearest" handles only
+              the cells on the border of the gaps.
+            Return value: True if success, False if fill is unknown
+        """
+        if fill == "zero":
+            table[mask] = 0.0
+        elif fill == "edge":
+            n = table.shape[1]
+            index = numpy.where(mask, 0, numpy.arange(n))
+            numpy.maximum.accumulate(index, axis=1, out=index)
+            # Leading gaps of a row take the first valid value instead
+            first = numpy.argmax(~mask, axis=1)
+            leading = mask & (numpy.arange(n) < first[:, None])
+            index[leading] = numpy.broadcast_to(first[:, None], index.shape)[leading]
+            rows = numpy.arange(table.shape[0])[:, None]
+            valid = ~mask.all(axis=1)
+            table[valid] = table[rows, index][valid]
+            table[~valid] = 0.0
+        elif fill == "nearest":
+            if mask.all():
+                table[:] = 0.0
+                return True
+            mask = mask.copy()
+            rows, columns = mask.shape
+            near = numpy.zeros(mask.shape, dtype=bool)
+            near[:-1] |= ~mask[1:]
+            near[1:] |= ~mask[:-1]
+            near[:, :-1] |= ~mask[:, 1:]
+            near[:, 1:] |= ~mask[:, :-1]
+            # Each pass visits only the frontier, the gap cells next to valid ones, so the cost
+            # is linear in the number of filled cells instead of the table size times the gap width
+            i, j = numpy.nonzero(mask & near)
+            while len(i) > 0:
+                total = numpy.zeros(len(i))
+                hits = numpy.zeros(len(i))
+                for di, dj in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+                    ni, nj = i+di, j+dj
+                    inside = (ni >= 0) & (ni < rows) & (nj >= 0) & (nj < columns)
+                    ni, nj = numpy.where(inside, ni, i), numpy.where(inside, nj, j)
+                    valid = inside & ~mask[ni, nj]
+                    total += numpy.where(valid, table[ni, nj], 0.0)
+                    hits += valid
+                table[i, j] = total / hits
+                mask[i, j] = False
+                # The next frontier is the gap cells next to the ones just filled
+                ni = numpy.concatenate((i+1, i-1, i, i))
+                nj = numpy.concatenate((j, j, j+1, j-1))
+                inside = (ni >= 0) & (ni < rows) & (nj >= 0) & (nj < columns)
+                ni, nj = ni[inside], nj[inside]
+                cells = numpy.unique(ni[mask[ni, nj]]*columns + nj[mask[ni, nj]])
+                i, j = cells // columns, cells % columns
+        else:
+            self.printerror("Unknown nodata fill " + str(fill))
+            return False
         return True
 
-    def toFile(self, filename, overwrite=False):
-        """ TerrainGenerator.toFile(filename):
+    def fromMosaic(self, filenames, xmin, ymin, xmax, ymax, fill="zero", processes=None):
+        """ TerrainGenerator.fromMosaic(filenames, xmin, ymin, xmax, ymax, fill, processes)
+            - fromMosaic() builds one terrain of the world rectangle xmin,ymin - xmax,ymax out of many
+              adjacent ASC tiles. Only the headers of the tiles are read first, to build an index
+              of their extents. The tiles which overlap the rectangle are then read in parallel
+              worker processes, and each worker returns only the part of its tile inside the
+              rectangle. Peak memory is thus the output terrain plus one tile per worker.
+            - All tiles must share the same cellsize, which becomes the cellsize of the terrain.
+              The rectangle is snapped to whole cells.
+            - Cells covered by no tile, or by nodata, are marked in self.m_array and filled
+              according to fill, see __fromASCFile().
+            - processes is the size of the worker pool. None uses all CPUs and 1 reads the tiles
+              in this process.
+            Return value: True if success, otherwise False
+        """
+        index = []
+        for filename in filenames:
+            try: f = open(filename, "r")
+            except IOError: self.printerror("Requested file %s does not exist." % filename); return False
+            header, first = self.__readASCHeader(f)
+            f.close()
+            if header == None:
+                self.printerror("File %s has no valid ASC header." % filename)
+                return False
+            index.append((filename, header))
+        if len(index) == 0:
+            self.printerror("fromMosaic(): no tiles given.")
+            return False
+        cellsize = index[0][1]["cellsize"]
+        if len([1 for filename, header in index if header["cellsize"] != cellsize]) > 0:
+            self.printerror("fromMosaic(): tiles have different cellsizes.")
+            return False
+
+        # Extents of all tiles as arrays, so the overlap query is a single vectorized test
+        west = numpy.array([header["xllcorner"] for filename, header in index])
+        south = numpy.array([header["yllcorner"] for filename, header in index])
+        east = west + cellsize*numpy.array([header["ncols"] for filename, header in index])
+        north = south + cellsize*numpy.array([header["nrows"] for filename, header in index])
+        overlapping = numpy.nonzero((west < xmax) & (east > xmin) & (south < ymax) & (north > ymin))[0]
+
+        cols = int(round((xmax - xmin) / cellsize))
+        rows = int(round((ymax - ymin) / cellsize))
+        if cols < 1 or rows < 1:
+            self.printerror("fromMosaic(): empty rectangle.")
+            return False
+        jobs = []
+        for k in overlapping:
+            filename, header = index[k]
+            col = int(round((header["xllcorner"] - xmin) / cellsize))
+            row = int(round((ymax - north[k]) / cellsize))
+            jobs.append((filename, header["ncols"], header["nrows"], col, row, cols, rows))
+
+        self.initialize(((cols/self.cPatchSize)+1), ((rows/self.cPatchSize)+1))
+        self.cellsize = cellsize
+        self.xllcorner = xmin
+        self.yllcorner = ymax - rows*cellsize
+        table = self.d_array[:cols, :rows]
+        mask = numpy.ones([cols, rows], dtype=bool)
+        if processes == 1:
+            results = (_readMosaicTile(job) for job in jobs)
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(_readMosaicTile, jobs)
+        try:
+            for result in results:
+                if result == None:
+                    self.printerror("fromMosaic(): reading a tile failed.")
+                    return False
+                c0, c1, r0, r1, heights, nodata = result
+                table[c0:c1, r0:r1] = heights
+                mask[c0:c1, r0:r1] = nodata
+        finally:
+            if processes != 1:
+                pool.terminate()
+
+        if mask.any():
+            if self.__fillNodata(table, mask, fill) == False:
+                return False
+        else:
+            mask = None
+        self.__padTable(cols, rows, mask)
+        return True
+
+    def toFile(self, filename, overwrite=False, byteorder="<"):
+        """ TerrainGenerator.toFile(filename, overwrite, byteorder):
             - tofile() writes the current terrain vector into file in a local filesystem. What ever is at the moment
               written in internal data table, is written to the file.
-            - output file format is NTF, which is directly loadable by Tundra.
+            - output file format is NTF, which is directly loadable by Tundra. The table is reordered into
+              patch-major order with a single reshape/transpose and written in blocks of patch rows.
+            - byteorder defaults to little-endian ("<") which is what Tundra expects. Big-endian (">") files
+              can be written for other consumers.
             Return value: True if generator succeeded, otherwise False
         """
-        if os.path.exists(filename):
-            if overwrite == False:
-                self.printerror("Requested output file " + str(filename) + " already exists. Aborting.")
+        if self.__removeOutput(filename, overwrite) == False:
+            return False
+        return self.__writeNTF(filename, self.__view(), byteorder)
+
+    def toPyramid(self, basename, levels=None, overwrite=False, byteorder="<"):
+        """ TerrainGenerator.toPyramid(basename, levels, overwrite, byteorder)
+            - toPyramid() writes the terrain as a pyramid of levels of detail. Level 0 is the terrain
+              itself, and each next level averages 2*2 samples of the previous one, so it has half
+              the resolution and twice the cellsize. Levels with an odd number of patches are padded
+              by repeating the last samples, so that every level consists of full patches.
+            - Each level is written into NTF file basename_<level>.ntf. Levels are made until the
+              terrain is a single patch, or until the given number of levels is reached.
+            - The index basename.idx lists the levels, one per line as
+              "level filename width height cellsize", width and height in patches.
+            Return value: True if success, otherwise False
+        """
+        index = basename + ".idx"
+        if self.__removeOutput(index, overwrite) == False:
+            return False
+        table = self.__view()
+        width, height = self.width, self.height
+        cellsize = self.cellsize
+        lines = []
+        level = 0
+        while True:
+            filename = "%s_%d.ntf" % (basename, level)
+            if self.__removeOutput(filename, overwrite) == False:
                 return False
-            os.remove(filename)
+            if self.__writeNTF(filename, table, byteorder) == False:
+                return False
+            lines.append("%d %s %d %d %r\n" % (level, os.path.basename(filename), width, height, cellsize))
+            level += 1
+            if (width == 1 and height == 1) or (levels != None and level >= levels):
+                break
+            # Each level is a single reduction of the previous one
+            rows, columns = table.shape
+            table = table.reshape(rows//2, 2, columns//2, 2).sum(axis=(1, 3))
+            table *= 0.25
+            width, height = (width+1)//2, (height+1)//2
+            cellsize = cellsize*2
+            padding = (0, width*self.cPatchSize - rows//2), (0, height*self.cPatchSize - columns//2)
+            if padding != ((0, 0), (0, 0)):
+                table = numpy.pad(table, padding, mode="edge")
+
+        try:
+            f = open(index, "w")
+            f.writelines(lines)
+            f.close()
+        except IOError:
+            self.printerror("Failed to write index " + str(index) + ". Aborting!")
+            return False
+        return True
+
+    def toWorldTiles(self, basename, columns, rows, operations, halo=None, processes=None, overwrite=False, byteorder="<"):
+        """ TerrainGenerator.toWorldTiles(basename, columns, rows, operations, halo, processes, overwrite, byteorder)
+            - toWorldTiles() generates a world of columns*rows terrains, each of the size of this
+              terrain, and writes them into NTF files basename_<column>_<row>.ntf. Neighbouring
+              tiles share their edge rows, so tile column,row starts from world sample
+              (column*(width-1), row*(height-1)) where width and height are the tile size in samples.
+            - operations is the list of algorithms run on every tile, as (name, args, kwargs) like
+              ("applyPerlinNoise", (6,), (("seed", 1),)), where kwargs is a tuple of (keyword,
+              value) pairs. This is the format of TerrainCache.key() and TerrainCache.run(), so a
+              world can be cached with the list it is generated from. The tiles start flat. Noise is evaluated
+              at world coordinates, with frequencies over the whole world width. Only algorithms
+              which depend on nearby samples alone can be used: applyPerlinNoise, applyPertubation,
+              smoothen, applyErosion, adjustHeight and saturate.
+            - Each tile is generated with a halo of neighbouring world samples around it, which
+              stencil algorithms read like the neighbour would. halo=None takes the reach of the
+              operations. The halo is rounded up to whole patches and cut away before writing.
+            - The tiles are generated in a pool of processes workers. None uses all CPUs and 1
+              generates the tiles in this process. Finally the shared edges are copied from the
+              tile before into the tile after, so that they are bit-identical in both files.
+            - The index basename.idx lists the tiles, one per line as
+              "column row filename x y", where x,y is the world sample of the first tile sample.
+            Return value: True if success, otherwise False
+        """
+        calls = []
+        for name, args, kwargs in operations:
+            if name not in ("applyPerlinNoise", "applyPertubation", "smoothen", "applyErosion", "adjustHeight", "saturate"):
+                self.printerror("toWorldTiles(): operation " + str(name) + " can not be used for world tiles.")
+                return False
+            try: params = inspect.getcallargs(getattr(self, name), *args, **dict(kwargs))
+            except TypeError, e:
+                self.printerror("toWorldTiles(): " + str(e))
+                return False
+            if name == "smoothen" and params["edge"] == "wrap":
+                self.printerror("toWorldTiles(): smoothen() of world tiles can not wrap.")
+                return False
+            calls.append((name, params))
+        if halo == None:
+            halo = self.__worldReach(calls)
+        halo = -(-halo // self.cPatchSize)
+        index = basename + ".idx"
+        if self.__removeOutput(index, overwrite) == False:
+            return False
+
+        width = self.width*self.cPatchSize
+        height = self.height*self.cPatchSize
+        world = ((width-1)*columns + 1, (height-1)*rows + 1)
+        jobs = []
+        for i in range(columns):
+            for j in range(rows):
+                filename = "%s_%d_%d.ntf" % (basename, i, j)
+                if self.__removeOutput(filename, overwrite) == False:
+                    return False
+                jobs.append((filename, i, j, (i*(width-1), j*(height-1)), world, self.width, self.height, halo,
+                             operations, self.dtype.char, byteorder))
+        if processes == 1:
+            results = [_worldTileTask(job) for job in jobs]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_worldTileTask, jobs)
+            finally:
+                pool.terminate()
+
+        # Stitch the shared edges in tile order, so every tile copies final edges
+        edges = {}
+        for job, (lastrow, lastcolumn) in zip(jobs, results):
+            filename, i, j = job[:3]
+            if i > 0 or j > 0:
+                patches = numpy.memmap(filename, dtype=byteorder+"f4", mode="r+", offset=8,
+                                       shape=(self.width, self.height, self.cPatchSize, self.cPatchSize))
+                if i > 0:
+                    patches[0, :, 0, :] = edges[(i-1, j)][0].reshape(self.height, self.cPatchSize)
+                    lastcolumn[0] = edges[(i-1, j)][0][-1]
+                if j > 0:
+                    patches[:, 0, :, 0] = edges[(i, j-1)][1].reshape(self.width, self.cPatchSize)
+                    lastrow[0] = edges[(i, j-1)][1][-1]
+                patches.flush()
+                del patches
+            edges[(i, j)] = (lastrow, lastcolumn)
+
+        try:
+            f = open(index, "w")
+            for job in jobs:
+                filename, i, j, origin = job[:4]
+                f.write("%d %d %s %d %d\n" % (i, j, os.path.basename(filename), origin[0], origin[1]))
+            f.close()
+        except IOError:
+            self.printerror("Failed to write index " + str(index) + ". Aborting!")
+            return False
+        return True
+
+    def _generateWorldTile(self, job):
+        """ TerrainGenerator._generateWorldTile(job)
+            - Worker side of toWorldTiles(). Generates one tile with its halo, writes it and
+              returns its last row and last column for stitching.
+            Return value: (lastrow, lastcolumn) float32 arrays
+        """
+        filename, i, j, origin, world, width, height, halo, operations, dtype, byteorder = job
+        self.initialize(width + 2*halo, height + 2*halo)
+        self.worldOrigin = (origin[0] - halo*self.cPatchSize, origin[1] - halo*self.cPatchSize)
+        self.worldSize = world
+        for name, args, kwargs in operations:
+            getattr(self, name)(*args, **dict(kwargs))
+        self.crop(halo*self.cPatchSize, halo*self.cPatchSize, width, height)
+        self.toFile(filename, overwrite=True, byteorder=byteorder)
+        heights = self.__view()
+        return heights[-1, :].astype(numpy.float32), heights[:, -1].astype(numpy.float32)
+
+    def __worldSize(self):
+        """ TerrainGenerator.__worldSize()
+            Return value: (width, height) in samples of the world the terrain belongs to
+        """
+        if self.worldSize != None:
+            return self.worldSize
+        return (self.width*self.cPatchSize, self.height*self.cPatchSize)
+
+    def __worldReach(self, calls):
+        """ TerrainGenerator.__worldReach(calls)
+            - Returns how far the result of a sample may depend on other samples after the given
+              toWorldTiles() operations, as (name, parameters) pairs with all the parameters of
+              each call bound by name.
+            Return value: reach in samples
+        """
+        reach = 0
+        for name, params in calls:
+            if name == "smoothen":
+                passes, radius = params["passes"], params["radius"]
+                if params["kernel"] == "gaussian":
+                    sigma = params["sigma"]
+                    if sigma == None: sigma = radius
+                    passes, radius = passes*3, self.__gaussianBoxRadius(sigma)
+                reach += passes*radius
+            elif name == "applyErosion":
+                reach += 2*params["iterations"] + 1
+            elif name == "applyPertubation":
+                reach += int(ceil(abs(params["displacement"]))) + 1
+        return reach
+
+    def __writeNTF(self, filename, table, byteorder="<"):
+        """ TerrainGenerator.__writeNTF(filename, table, byteorder)
+            - Writes table of whole patches into NTF file filename, one block of patch rows at a
+              time, so that only a block of the table is converted in memory.
+            Return value: True if success, otherwise False
+        """
         try: f = open(filename, "wb")
         except IOError:
             self.printerror("Failed to open file " + str(filename) + ". Aborting!")
             return False
 
-        s_buf = array.array("I")
-        s_buf.fromlist([self.width, self.height])
+        width, height = table.shape[0]//self.cPatchSize, table.shape[1]//self.cPatchSize
+        s_buf = numpy.array([width, height], dtype=byteorder+"u4")
         s_buf.tofile(f)
-        for i in range(self.width):
-            for j in range(self.height):
-                d_patch = []
-                for x in range(self.cPatchSize):
-                    for y in range(self.cPatchSize):
-                        d_patch.append(self.d_array[i*self.cPatchSize+x][j*self.cPatchSize+y])
-                d_buf = array.array("f")
-                d_buf.fromlist(d_patch)
-                d_buf.tofile(f)
+        for start, stop in self.__rowBlocks(width, height*self.cPatchSize*self.cPatchSize):
+            d_buf = self.__tableToPatches(table[start*self.cPatchSize:stop*self.cPatchSize])
+            d_buf.astype(byteorder+"f4").tofile(f)
         f.close()
         return True
 
@@ -237,86 +904,335 @@ class TerrainGenerator():
         """ TerrainGenerator.fromSurfaceImage(imagefile)
             - fromimage() takes an image file as an input, opens it with PIL, scales the content to match
               requested terrain size, and then uses the image as a height map to create the terrain
-            - R, G and B values for each pixels are averaged and used as a height for each individual
-              node in the terrain. The values are used directly, i.e. from zero to 255.
+            - Single channel images (modes L, I;16, I and F) are used as such, so 16 bit heightmaps
+              keep their precision. For color images R, G and B values for each pixels are averaged.
+              The values are used directly, e.g. from zero to 255 or from zero to 65535.
+            - The image is scaled in floating point mode.
             Return value: True if file input succeeded, otherwise False
         """
-        try: image = Image.open(imagefile)
+        try:
+            image = Image.open(imagefile)
+            if image.mode in ("L", "I", "F") or image.mode.startswith("I;16"):
+                values = numpy.asarray(image)
+            else:
+                values = numpy.asarray(image.convert("RGB"), dtype=numpy.float32).mean(axis=2, dtype=numpy.float32)
         except IOError:
             self.printerror("File input from " + str(imagefile) + " failed. Aborting!")
             return False
 
-        image2 = image.resize((self.width*self.cPatchSize, self.height*self.cPatchSize), Image.ANTIALIAS)
-        pixels = image2.load()
-        for i in range(self.width*self.cPatchSize):
-            for j in range(self.height*self.cPatchSize):
-                self.d_array[i][j] = (pixels[i,j][0] + pixels[i,j][1] + pixels[i,j][2]) / 3.0
+        size = (self.width*self.cPatchSize, self.height*self.cPatchSize)
+        if image.size != size:
+            values = Image.fromarray(values.astype(numpy.float32), "F")
+            values = numpy.asarray(values.resize(size, Image.ANTIALIAS))
+        # PIL pixel orientation is transposed compared to our internal presentation
+        self.__heights()[...] = values.T
         self.minvalid = False
         self.maxvalid = False
         return True
 
-    def toSurfaceImage(self, filename, fileformat="PNG", overwrite=False):
-        """ TerrainGenerator.toSurfaceImage(imagefile)
+    def toSurfaceImage(self, filename, fileformat="PNG", overwrite=False, bits=None):
+        """ TerrainGenerator.toSurfaceImage(imagefile, fileformat, overwrite, bits)
             - toSurfaceMap() outputs the currently generated terrain into an RGB picture containing
               normalized height of each node in the terrain. Single pixel corresponds to single
               height value and is stored in grayscale RGB value. Height values are normalized to
               range of 0-255 before storing to gain maximum dynamics for the terrain.
-            - RGB may be an overkill. Maybe single value grayscale image would be more elegant way
-              to store the information
+            - bits=8 or bits=16 stores a single channel grayscale image instead, normalized to
+              0-255 or 0-65535, rounded to the nearest level. 16 bit images need a format which
+              supports them, like PNG. Other values of bits are rejected.
             Return value: True if file input succeeded, otherwise False
         """
-        if os.path.exists(filename):
-            if overwrite == False:
-                self.printerror("Requested output file " + str(filename) + " already exists. Aborting.")
-                return False
-            os.remove(filename)
-
-        image = Image.new("RGB", (self.width*self.cPatchSize, self.height*self.cPatchSize))
+        if bits not in (None, 8, 16):
+            self.printerror("toSurfaceImage() bits must be None, 8 or 16, not " + str(bits) + ".")
+            return False
+        if self.__removeOutput(filename, overwrite) == False:
+            return False
 
-        data = []
         minitem = self.getMinitem()
         maxitem = self.getMaxitem()
-        scalefactor = 255.0 / (maxitem - minitem)
-        for i in range(self.width*self.cPatchSize):
-            for j in range(self.height*self.cPatchSize):
-                # Here we need j,i orientation because PIL pixel orientation differs from our
-                # internal presentation
-                value = (self.d_array[j][i] - minitem) * scalefactor
-                ivalue = int(value)
-                data.append(ivalue*256*256 + ivalue*256 + ivalue)
-        image.putdata(data)
-        try: image.save(filename, fileformat)
-        except IOError:
-            self.printerror("toWeightmap() image save failed to " +str(filename)+ ". IOError.")
-            return False
-        return True
+        if bits == 16:
+            top, dtype = 65535.0, numpy.uint16
+        else:
+            top, dtype = 255.0, numpy.uint8
+        # Here we need transposed orientation because PIL pixel orientation differs from our
+        # internal presentation. Scaling is done in double precision, in blocks of rows.
+        view = self.__view()
+        values = numpy.empty(view.shape[::-1], dtype=dtype)
+        for start, stop in self.__rowBlocks(view.shape[0], view.shape[1]):
+            scaled = (numpy.asarray(view[start:stop], dtype=numpy.float64) - minitem) * (top / (maxitem - minitem))
+            scaled = numpy.clip(scaled, 0.0, top)
+            # Grayscale images round to the nearest level, RGB truncates like it always has
+            if bits != None:
+                scaled = numpy.rint(scaled)
+            values[:, start:stop] = scaled.astype(dtype).T
+        if bits == None:
+            values = numpy.dstack((values, values, values))
+        return self.__saveImage(Image.fromarray(values), filename, fileformat)
 
-    def toWeightmap(self, filename, fileformat="TGA", overwrite=False, maxitem = None):
-        """ TerrainGenerator.toWeightmap(filename, fileformat)
+    def toWeightmap(self, filename, fileformat="TGA", overwrite=False, maxitem = None, seed=0, rules=None, size=None):
+        """ TerrainGenerator.toWeightmap(filename, fileformat, overwrite, maxitem, seed, rules, size)
             - toWeightmap() takes the current input terrain vector and creates a texture
               representing the surface texturing.
             - the algorithm runs through the vector and translates height values into RGB values
               where each RGB value acts as an input for the final terrain shader renderer.
+            - The band thresholds are jittered with random noise, which is seeded by seed.
+            - If rules are given, the weights come from the rules instead, see computeWeights().
+              Up to four rules map to the R, G, B and A channels, i.e. to the detail textures of
+              Material.createMaterial_4channelTerrain(). size=(columns, rows) of the image
+              defaults to the terrain size.
             Return value: True always
         """
+        if self.__removeOutput(filename, overwrite) == False:
+            return False
+
+        if rules != None:
+            if len(rules) < 1 or len(rules) > 4:
+                self.printerror("toWeightmap(): 1 to 4 rules are needed, got " + str(len(rules)))
+                return False
+            if size == None: size = (self.height*self.cPatchSize, self.width*self.cPatchSize)
+            weights = self.computeWeights(rules, (size[1], size[0]))
+            channels = max(3, len(rules))
+            image = numpy.zeros(weights.shape[1:] + (channels,), dtype=numpy.uint8)
+            for k in range(len(rules)):
+                image[:, :, k] = numpy.rint(weights[k] * 255.0)
+            return self.__saveImage(Image.fromarray(image), filename, fileformat)
+
+        if maxitem == None:
+            maxitem = self.getMaxitem()
+        weights = self.__heightBands(self.__view(), 0.5, maxitem/2, 2, self.__randomState(seed))
+        return self.__saveImage(Image.fromarray(weights), filename, fileformat)
+
+    def toNormalmap(self, filename, fileformat="TGA", overwrite=False):
+        """ TerrainGenerator.toNormalmap(filename, fileformat, overwrite)
+            - toNormalmap() bakes the surface normals of computeNormals() into an RGB texture, where
+              R, G and B hold the x, y and up components scaled from -1..1 into 0..255.
+            - Like the other baked textures, the image is oriented as toWeightmap() output, so they
+              can be used together in the terrain material.
+            Return value: True if success, otherwise False
+        """
+        if self.__removeOutput(filename, overwrite) == False:
+            return False
+        normals = self.computeNormals()
+        normals += 1.0
+        normals *= 127.5
+        return self.__saveImage(Image.fromarray(numpy.rint(normals).astype(numpy.uint8)), filename, fileformat)
+
+    def toSlopemap(self, filename, fileformat="TGA", overwrite=False):
+        """ TerrainGenerator.toSlopemap(filename, fileformat, overwrite)
+            - toSlopemap() bakes computeSlope() into a grayscale texture, 0 for flat and 255 for
+              vertical surfaces.
+            Return value: True if success, otherwise False
+        """
+        if self.__removeOutput(filename, overwrite) == False:
+            return False
+        values = numpy.rint(self.computeSlope() * (255.0/90.0)).astype(numpy.uint8)
+        return self.__saveImage(Image.fromarray(values), filename, fileformat)
+
+    def toAmbientOcclusionMap(self, filename, fileformat="TGA", overwrite=False, directions=8, radius=16, samples=8):
+        """ TerrainGenerator.toAmbientOcclusionMap(filename, fileformat, overwrite, directions, radius, samples)
+            - toAmbientOcclusionMap() bakes computeAmbientOcclusion() into a grayscale texture, 255
+              for open and 0 for fully occluded surfaces.
+            Return value: True if success, otherwise False
+        """
+        if self.__removeOutput(filename, overwrite) == False:
+            return False
+        values = self.computeAmbientOcclusion(directions, radius, samples)
+        values = numpy.rint(numpy.clip(values, 0.0, 1.0) * 255.0).astype(numpy.uint8)
+        return self.__saveImage(Image.fromarray(values), filename, fileformat)
+
+    def computeWeights(self, rules, shape=None):
+        """ TerrainGenerator.computeWeights(rules, shape)
+            - computeWeights() evaluates a list of texture layer rules over the terrain. Each rule
+              is a dictionary which may limit the layer by "height", "slope" (in degrees) and
+              "curvature" (laplacian of the height, positive in valleys). A limit is a tuple
+              (min, max) or (min, max, falloff): the weight ramps smoothly from zero at min-falloff
+              to full at min, and back to zero from max to max+falloff. Either end may be None.
+              An optional "weight" scales the layer. A rule without limits covers everything.
+            - Slope (see computeSlope()) and curvature are computed once with finite differences,
+              using self.cellsize as the sample spacing, and all rules are evaluated over whole arrays.
+            - The weights are normalized to sum up to one at each sample. Samples no rule covers go
+              to the first layer.
+            - shape=(rows, columns) resamples the fields bilinearly, so the weights can be made at a
+              different resolution than the terrain.
+            Return value: (len(rules), rows, columns) float array of weights
+        """
+        heights = self.__view()
+        slope = self.computeSlope()
+        curvature = self.__laplacian(heights) / (self.cellsize*self.cellsize)
+        fields = { "height":heights, "slope":slope, "curvature":curvature }
+        if shape != None and tuple(shape) != heights.shape:
+            for name in fields:
+                fields[name] = self.__resample(fields[name], shape)
+
+        weights = numpy.ones((len(rules),) + fields["height"].shape)
+        for k, rule in enumerate(rules):
+            for name in ("height", "slope", "curvature"):
+                if name in rule:
+                    weights[k] *= self.__ruleMembership(fields[name], rule[name])
+            weights[k] *= rule.get("weight", 1.0)
+        total = weights.sum(axis=0)
+        uncovered = (total <= 0.0)
+        weights[0][uncovered] = 1.0
+        total[uncovered] = 1.0
+        weights /= total
+        return weights
+
+    def computeNormals(self):
+        """ TerrainGenerator.computeNormals()
+            - computeNormals() returns the unit surface normal of each sample, from the height
+              gradient of a 3*3 Sobel filter, using self.cellsize as the sample spacing.
+            Return value: (rows, columns, 3) float32 array of x (first axis), y and up components
+        """
+        gradx, grady = self.__sobel(self.__view())
+        normals = numpy.empty(gradx.shape + (3,), dtype=numpy.float32)
+        scale = numpy.multiply(gradx, gradx)
+        scale += grady*grady
+        scale += 1.0
+        numpy.sqrt(scale, out=scale)
+        numpy.reciprocal(scale, out=scale)
+        normals[:, :, 2] = scale
+        numpy.negative(scale, out=scale)
+        normals[:, :, 0] = gradx*scale
+        normals[:, :, 1] = grady*scale
+        return normals
+
+    def computeSlope(self):
+        """ TerrainGenerator.computeSlope()
+            - computeSlope() returns the steepness of each sample in degrees, from the same Sobel
+              gradient as computeNormals().
+            Return value: 2-dimensional float array of slopes from 0 to 90
+        """
+        gradx, grady = self.__sobel(self.__view())
+        return numpy.degrees(numpy.arctan(numpy.hypot(gradx, grady)))
+
+    def computeAmbientOcclusion(self, directions=8, radius=16, samples=8):
+        """ TerrainGenerator.computeAmbientOcclusion(directions, radius, samples)
+            - computeAmbientOcclusion() estimates how open the sky is above each sample. Along each of
+              the directions it finds the highest horizon within radius samples, and the occlusion is
+              the sine of the horizon elevation averaged over the directions.
+            - Horizons are searched at samples distances spaced geometrically from 1 to radius. Each
+              distance is one shifted array operation on a block of rows, so the terrain is swept
+              block by block with vectorized running maxima instead of marching rays per sample.
+            Return value: 2-dimensional float32 array, 1 for open and 0 for fully occluded samples
+        """
+        heights = self.__view()
+        rows, columns = heights.shape
+        padded = numpy.pad(heights.astype(numpy.float32), radius, mode="edge")
+        distances = numpy.unique(numpy.rint(numpy.geomspace(1, radius, samples)).astype(int))
+        steps = []
+        for k in range(directions):
+            angle = 2.0*pi*k/directions
+            direction = []
+            for distance in distances:
+                di, dj = int(round(distance*cos(angle))), int(round(distance*sin(angle)))
+                direction.append((di, dj, 1.0/(hypot(di, dj)*self.cellsize)))
+            steps.append(direction)
+
+        occlusion = numpy.zeros((rows, columns), dtype=numpy.float32)
+        for start, stop in self.__rowBlocks(rows, columns, 1<<16):
+            center = padded[radius+start:radius+stop, radius:radius+columns]
+            horizon = numpy.empty(center.shape, dtype=numpy.float32)
+            tangent = numpy.empty(center.shape, dtype=numpy.float32)
+            total = occlusion[start:stop]
+            for direction in steps:
+                horizon.fill(0.0)
+                for di, dj, inverse in direction:
+                    numpy.subtract(padded[radius+start+di:radius+stop+di, radius+dj:radius+dj+columns], center, out=tangent)
+                    tangent *= inverse
+                    numpy.maximum(horizon, tangent, out=horizon)
+                # sin(atan(t)) = t / sqrt(1 + t*t)
+                numpy.multiply(horizon, horizon, out=tangent)
+                tangent += 1.0
+                numpy.sqrt(tangent, out=tangent)
+                horizon /= tangent
+                total += horizon
+        occlusion *= -1.0/directions
+        occlusion += 1.0
+        return occlusion
+
+    def __sobel(self, table):
+        """ TerrainGenerator.__sobel(table)
+            - Height gradient of table along both axes with 3*3 Sobel filters, with the border
+              samples repeated outwards. The table is filtered in blocks of rows.
+            Return value: (gradx, grady) float32 arrays of the shape of table
+        """
+        rows, columns = table.shape
+        gradx = numpy.empty(table.shape, dtype=numpy.float32)
+        grady = numpy.empty(table.shape, dtype=numpy.float32)
+        for start, stop in self.__rowBlocks(rows, columns, 1<<16):
+            index = numpy.clip(numpy.arange(start-1, stop+1), 0, rows-1)
+            block = numpy.pad(table[index], ((0, 0), (1, 1)), mode="edge")
+            smooth = block[:, :-2] + 2.0*block[:, 1:-1] + block[:, 2:]
+            gradx[start:stop] = smooth[2:] - smooth[:-2]
+            smooth = block[:-2] + 2.0*block[1:-1] + block[2:]
+            grady[start:stop] = smooth[:, 2:] - smooth[:, :-2]
+        gradx *= 1.0/(8.0*self.cellsize)
+        grady *= 1.0/(8.0*self.cellsize)
+        return gradx, grady
+
+    def __ruleMembership(self, field, limit):
+        """ TerrainGenerator.__ruleMembership(field, limit)
+            - Evaluates a (min, max[, falloff]) limit of a weightmap rule, with a smoothstep ramp of
+              falloff width outside both ends.
+            Return value: array of memberships in range [0, 1]
+        """
+        low, high = limit[0], limit[1]
+        falloff = 0.0
+        if len(limit) > 2: falloff = float(limit[2])
+        membership = numpy.ones(field.shape)
+        for bound, sign in ((low, 1.0), (high, -1.0)):
+            if bound == None: continue
+            if falloff > 0.0:
+                t = numpy.clip(sign*(field - bound)/falloff + 1.0, 0.0, 1.0)
+                membership *= t*t*(3.0 - 2.0*t)
+            else:
+                membership *= (sign*(field - bound) >= 0.0)
+        return membership
+
+    def __laplacian(self, table):
+        """ TerrainGenerator.__laplacian(table)
+            - Five point laplacian of table, with the border samples repeated outwards.
+            Return value: array of the shape of table
+        """
+        padded = numpy.pad(table, 1, mode="edge")
+        return padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:] - 4.0*table
+
+    def __resample(self, table, shape):
+        """ TerrainGenerator.__resample(table, shape)
+            - Bilinearly resamples table to shape, aligning the corner samples.
+            Return value: resampled array
+        """
+        result = table
+        for axis in (0, 1):
+            n = result.shape[axis]
+            position = numpy.linspace(0.0, n-1, shape[axis])
+            index = numpy.minimum(position.astype(numpy.int64), max(n-2, 0))
+            fraction = position - index
+            upper = numpy.minimum(index+1, n-1)
+            if axis == 0:
+                result = result[index]*(1.0-fraction[:, None]) + result[upper]*fraction[:, None]
+            else:
+                result = result[:, index]*(1.0-fraction) + result[:, upper]*fraction
+        return result
+
+    def __removeOutput(self, filename, overwrite):
+        """ TerrainGenerator.__removeOutput(filename, overwrite)
+            - Clears the way for an output file. An existing file is removed if overwrite is set.
+            Return value: True if the file can be written, otherwise False
+        """
         if os.path.exists(filename):
             if overwrite == False:
                 self.printerror("Requested output file " + str(filename) + " already exists. Aborting.")
                 return False
             os.remove(filename)
+        return True
 
-        image = Image.new("RGB", (self.width*self.cPatchSize, self.height*self.cPatchSize))
-        data = []
-        if maxitem == None:
-            maxitem = self.getMaxitem()
-        for i in range(self.width*self.cPatchSize):
-            for j in range(self.height*self.cPatchSize):
-                r, g, b = self.height_to_rgb(self.d_array[i][j], limit1=0.5, limit2=maxitem/2, variance=2)
-                data.append(r*256*256 + g*256 + b)
-        image.putdata(data)
+    def __saveImage(self, image, filename, fileformat):
+        """ TerrainGenerator.__saveImage(image, filename, fileformat)
+            Return value: True if the image was saved, otherwise False
+        """
         try: image.save(filename, fileformat)
         except IOError:
-            self.printerror("toWeightmap() image save failed to " +str(filename)+ ". IOError.")
+            self.printerror("Image save failed to " +str(filename)+ ". IOError.")
             return False
         return True
 
@@ -324,67 +1240,77 @@ class TerrainGenerator():
 # Terrain algorithms generator
 #
 
-    def fromDiamondsquare(self, size, seed1, seed2, seed3, seed4):
-        """ TerrainGenerator.fromDiamondsquare(size, seed1, seed2, seed3, seed4)
+    def fromDiamondsquare(self, size, seed1, seed2, seed3, seed4, rng=None):
+        """ TerrainGenerator.fromDiamondsquare(size, seed1, seed2, seed3, seed4, rng)
             - fromdiamondsquare() implements an algorithm which can be used to create simple
               fractal based terrains. The algorithm is described in detail in:
               http://www.gameprogrammer.com/fractal.html
             - The algorithm will require a square shaped vector for storage space. Another
               requirement for the vector is that its dimensions need to be a power of two. The
-              size of the terrain is at the moment limited to maximum of 128
+              size of the terrain is limited only by available memory.
             - seed[1-4] values are initial float corner values for the terrain and act as a seed
               for the generator.
+            - rng is an integer seed, numpy.random.RandomState or numpy.random.Generator used for
+              the random displacements. Equal seeds produce equal terrains. None seeds randomly.
+            - Each level of the algorithm updates all square and diamond midpoints at once with
+              array operations on the corner grid of the level.
             Return value: True if generator succeeded, otherwise False
         """
         if False == self.__sizeIsPowerOfTwo(size):
             return False;
 
+        rng = self.__randomState(rng)
         self.initialize(size, size)
         w = size*self.cPatchSize
-        h = w
-        self.d_array[0][0] = float(seed1)
-        self.d_array[w][0] = float(seed2)
-        self.d_array[0][h] = float(seed3)
-        self.d_array[w][h] = float(seed4)
-        #print "%d %d %d %d" % (self.d_array[0][0], self.d_array[w][0], self.d_array[0][h], self.d_array[w][h])
-        divider = 1
+        d = self.d_array
+        # The levels build on each other, so they are computed in double precision. Only every
+        # other row and column is read again by later levels, so the levels down to that grid
+        # run on a float64 table g of it, a view of d_array when it is float64 already.
+        if d.dtype == numpy.float64:
+            g = d[0::2, 0::2]
+        else:
+            g = self.__allocate([w//2+1, w//2+1], numpy.float64, self.__isTiled())
+        n = w//2
+        g[0][0] = float(seed1)
+        g[n][0] = float(seed2)
+        g[0][n] = float(seed3)
+        g[n][n] = float(seed4)
+        blocksize = n
         randrange = 32
-        while divider < w:
-            blocksize = w/divider
-            for i in range(divider):
-                for j in range(divider):
-                    # Square phase:
-                    value =         self.d_array[(i+0)*blocksize][(j+0)*blocksize]
-                    value = value + self.d_array[(i+1)*blocksize][(j+0)*blocksize]
-                    value = value + self.d_array[(i+0)*blocksize][(j+1)*blocksize]
-                    value = value + self.d_array[(i+1)*blocksize][(j+1)*blocksize]
-                    value = value / 4.0 + float(random.randint(-randrange, randrange))
-                    self.d_array[i*blocksize+blocksize/2][j*blocksize+blocksize/2] = value
-                    # Diamond phase:
-                    value =         self.d_array[(i+0)*blocksize][(j+0)*blocksize]
-                    value = value + self.d_array[(i+1)*blocksize][(j+0)*blocksize]
-                    value = value / 2.0 + float(random.randint(-randrange, randrange))
-                    self.d_array[i*blocksize+blocksize/2][j*blocksize] = value
-                    value =         self.d_array[(i+0)*blocksize][(j+0)*blocksize]
-                    value = value + self.d_array[(i+0)*blocksize][(j+1)*blocksize]
-                    value = value / 2.0 + float(random.randint(-randrange, randrange))
-                    self.d_array[i*blocksize][j*blocksize+blocksize/2] = value
-                    value =         self.d_array[(i+0)*blocksize][(j+1)*blocksize]
-                    value = value + self.d_array[(i+1)*blocksize][(j+1)*blocksize]
-                    value = value / 2.0 + float(random.randint(-randrange, randrange))
-                    self.d_array[i*blocksize+blocksize/2][j*blocksize+blocksize] = value
-                    value =         self.d_array[(i+1)*blocksize][(j+0)*blocksize]
-                    value = value + self.d_array[(i+1)*blocksize][(j+1)*blocksize]
-                    value = value / 2.0 + float(random.randint(-randrange, randrange))
-                    self.d_array[i*blocksize+blocksize][j*blocksize+blocksize/2] = value
-            divider = divider * 2
-            randrange = randrange / 2
+        while blocksize > 1:
+            half = blocksize // 2
+            corners = g[0::blocksize, 0::blocksize]
+            k = corners.shape[0] - 1
+            # Square phase:
+            g[half::blocksize, half::blocksize] = \
+                (corners[:-1, :-1] + corners[1:, :-1] + corners[:-1, 1:] + corners[1:, 1:]) / 4.0 + \
+                self.__randomIntegers(rng, -randrange, randrange, (k, k))
+            # Diamond phase:
+            g[half::blocksize, 0::blocksize] = \
+                (corners[:-1, :] + corners[1:, :]) / 2.0 + self.__randomIntegers(rng, -randrange, randrange, (k, k+1))
+            g[0::blocksize, half::blocksize] = \
+                (corners[:, :-1] + corners[:, 1:]) / 2.0 + self.__randomIntegers(rng, -randrange, randrange, (k+1, k))
+            blocksize = half
+            randrange = randrange // 2
+
+        # The last level writes d_array directly, in blocks of rows
+        for a, b in self.__rowBlocks(n, n):
+            d[2*a+1:2*b:2, 1::2] = (g[a:b, :-1] + g[a+1:b+1, :-1] + g[a:b, 1:] + g[a+1:b+1, 1:]) / 4.0 + \
+                self.__randomIntegers(rng, -randrange, randrange, (b-a, n))
+        for a, b in self.__rowBlocks(n, n):
+            d[2*a+1:2*b:2, 0::2] = (g[a:b, :] + g[a+1:b+1, :]) / 2.0 + \
+                self.__randomIntegers(rng, -randrange, randrange, (b-a, n+1))
+        for a, b in self.__rowBlocks(n+1, n):
+            d[2*a:2*b:2, 1::2] = (g[a:b, :-1] + g[a:b, 1:]) / 2.0 + \
+                self.__randomIntegers(rng, -randrange, randrange, (b-a, n))
+        if d.dtype != numpy.float64:
+            self.__copyRows(d[0::2, 0::2], g)
         self.minvalid = False
         self.maxvalid = False
         return True
 
-    def fromEnvelope(self, size, envelope):
-        """ TerrainGenerator.fromEnvelope(size, envelope)
+    def fromEnvelope(self, size, envelope, vectorized=None, blockrows=None):
+        """ TerrainGenerator.fromEnvelope(size, envelope, vectorized, blockrows)
             - fromEnvelope() method loops through the desired terrain array of floats
               and calls the envelope function for each node in the terrain soil to solve
               the particular height value.
@@ -394,6 +1320,13 @@ class TerrainGenerator():
               a float, which is used directly-
             - input params for the envelope are mapped to [-1, 1] for both X and Y directions
               hence the envelope can assume all input X,Y pairs to fall into this area.
+            - In vectorized mode the envelope is called with whole 2-dimensional X and Y
+              coordinate grids and it returns an array of heights of the same shape. With
+              vectorized=None the array call is tried first and if the envelope fails with
+              arrays, the method falls back to calling it once per node.
+            - blockrows limits how many terrain rows are generated with one envelope call,
+              which keeps the memory used by the coordinate grids bounded. None generates
+              the whole terrain at once.
             Return value: True if generator succeeded, otherwise False
         """
         if False == self.__sizeIsPowerOfTwo(size):
@@ -402,6 +1335,24 @@ class TerrainGenerator():
         self.initialize(size, size)
         w = size*self.cPatchSize
         h = w
+        if blockrows == None:
+            blockrows = w
+
+        coords = 2.0*numpy.arange(w)/(h-1)-1.0
+        for start in range(0, w, blockrows):
+            if vectorized == False:
+                break
+            stop = min(start+blockrows, w)
+            Y, X = numpy.meshgrid(coords[start:stop], coords, indexing="ij")
+            try:
+                self.d_array[start:stop, :w] = envelope(X, Y)
+            except (TypeError, ValueError):
+                if vectorized == True: raise
+                vectorized = False
+                break
+            vectorized = True
+        if vectorized == True:
+            return True
 
         for i in range(h):
             for j in range(w):
@@ -421,19 +1372,16 @@ class TerrainGenerator():
         """
         minitem = self.getMinitem()
         maxitem = self.getMaxitem()
-        for i in range(self.width*self.cPatchSize):
-            for j in range(self.height*self.cPatchSize):
-                self.d_array[i][j] = (self.d_array[i][j]-minitem) * (maxlimit-minlimit)/(maxitem-minitem) + minlimit
-        self.minitem = minlimit
-        self.maxitem = maxlimit
-        self.minvalid = True
-        self.maxvalid = True
+        self.__applyElementwise("rescale", (minitem, maxlimit-minlimit, maxitem-minitem, minlimit))
         return True
 
     def adjustHeight(self, delta):
-        for i in range(self.width*self.cPatchSize):
-            for j in range(self.height*self.cPatchSize):
-                self.d_array[i][j] += delta
+        """ TerrainGenerator.adjustHeight(delta)
+            - adjustHeight() raises or lowers the whole terrain by delta.
+            Return value: True always
+        """
+        self.__applyElementwise("adjust", (delta,))
+        return True
 
     def quantize(self, level=16):
         """ TerrainGenerator.quantize(level)
@@ -446,9 +1394,7 @@ class TerrainGenerator():
         minitem = self.getMinitem()
         maxitem = self.getMaxitem()
         threshold = (maxitem-minitem)/level
-        for i in range(self.width*self.cPatchSize):
-            for j in range(self.height*self.cPatchSize):
-                self.d_array[i][j] = value = floor((self.d_array[i][j]-minitem)/threshold) * threshold + minitem
+        self.__applyElementwise("quantize", (minitem, threshold))
         return True
 
     def saturate(self, level):
@@ -458,119 +1404,503 @@ class TerrainGenerator():
               positive then all positive numbers are saturated.
             Return value: True always
         """
-        if level > 0: # positive saturation
-            for i in range(self.width*self.cPatchSize):
-                for j in range(self.height*self.cPatchSize):
-                    if self.d_array[i][j] > level:
-                        self.d_array[i][j] = level
-            self.maxitem = level
-            self.maxvalid = True
+        self.__applyElementwise("saturate", (level,))
+        return True
+
+    def smoothen(self, passes=1, radius=1, kernel="box", sigma=None, edge="edge"):
+        """ TerrainGenerator.smoothen(passes, radius, kernel, sigma, edge)
+            - smoothen() low-pass filters the terrain with a separable kernel. Each 1-dimensional
+              filter is computed from cumulative sums within blocks of 2*radius+1 nodes, so the
+              cost of a pass does not depend on the kernel radius.
+            - kernel "box" averages (2*radius+1)^2 nodes. Kernel "gaussian" approximates a gaussian
+              of deviation sigma (radius if None) with three successive box filters.
+            - edge tells how the terrain is extended beyond its borders: "edge" repeats the border
+              nodes, "reflect" mirrors the terrain and "wrap" treats it as periodic.
+            - Passes ping-pong between two preallocated buffers.
+            - Disk-backed terrains are filtered tile by tile, and parallel terrains in bands of rows.
+              The halo of a tile or band covers the reach of all passes, and the blocks of the
+              cumulative sums are aligned to the terrain, so the result equals filtering the whole
+              terrain at once, bit for bit.
+            Return value: True if success, False if parameters are invalid
+        """
+        v = self.__heights()
+        if kernel == "box":
+            boxes = 1
+        elif kernel == "gaussian":
+            if sigma == None: sigma = radius
+            boxes = 3
+            radius = self.__gaussianBoxRadius(sigma)
+        else:
+            self.printerror("smoothen(): unknown kernel " + str(kernel))
+            return False
+        if edge not in ("edge", "reflect", "wrap"):
+            self.printerror("smoothen(): unknown edge mode " + str(edge))
+            return False
+        if edge != "edge" and radius >= min(v.shape):
+            self.printerror("smoothen(): radius exceeds the terrain size for edge mode " + edge)
+            return False
+        if radius < 1 or passes < 1:
+            return True
+
+        # Periodic terrains are extended by the reach of all passes on every side and filtered
+        # like a window of an endless terrain, the same way as its bands and tiles
+        halo = passes*boxes*radius
+        if edge == "wrap": windowedge = "edge"
+        else: windowedge = edge
+        if self.__isParallel():
+            self.__runParallel("smoothen", (passes*boxes, radius, windowedge), halo, edge == "wrap")
+        elif self.__isTiled():
+            self.__forEachTile(lambda window, origin: self.__smoothenTable(window, passes*boxes, radius, windowedge, origin),
+                               halo, edge == "wrap")
+        elif edge == "wrap":
+            rows = numpy.arange(-halo, v.shape[0]+halo) % v.shape[0]
+            cols = numpy.arange(-halo, v.shape[1]+halo) % v.shape[1]
+            window = self.__smoothenTable(numpy.array(v[rows[:, None], cols[None, :]]), passes*boxes, radius, "edge", (-halo, -halo))
+            v[...] = window[halo:halo+v.shape[0], halo:halo+v.shape[1]]
         else:
-            for i in range(self.width*self.cPatchSize):
-                for j in range(self.height*self.cPatchSize):
-                    if self.d_array[i][j] < level:
-                        self.d_array[i][j] = level
-            self.minitem = level
-            self.minvalid = True
+            self.__smoothenTable(v, passes*boxes, radius, edge)
+        self.minvalid = False
+        self.maxvalid = False
         return True
-        
-    def smoothen(self, passes=1):
-        width = self.width*self.cPatchSize
-        height = self.height*self.cPatchSize
-        
+
+    def __smoothenTable(self, v, passes, radius, edge, origin=(0, 0)):
+        """ TerrainGenerator.__smoothenTable(v, passes, radius, edge, origin)
+            - Box filters table v in place with the given number of separable passes. origin is
+              the position of v in the terrain, when v is a band or a tile of it.
+            Return value: the filtered table v
+        """
+        buffers = [numpy.array(v, dtype=float), numpy.empty(v.shape, dtype=float)]
+        scratch = []
+        k = 2*radius+1
+        for axis in (0, 1):
+            n, m = v.shape[axis], v.shape[1-axis]
+            rows = ((n+2*radius+k-1)//k + 1)*k
+            scratch.append([numpy.empty((rows, m), dtype=float) for buf in range(3)])
+        current = 0
         for p in range(passes):
-            for i in range(1, width-1):
-               for j in range(1, width-1):
-                    total = 0.0
-                    for u in range(-1, 2):
-                        for v in range(-1, 2):
-                            total += self.d_array[i+u][j+v]
-                    self.d_array[i][j] = total / 9.0
-        
-    def applyPerlinNoise(self, octaves=1, frequency=1, persistence=0.5, amplitude=100):
+            for axis in (0, 1):
+                self.__boxFilter1D(buffers[current], buffers[1-current], axis, radius, edge, origin[axis], scratch[axis])
+                current = 1 - current
+        v[...] = buffers[current]
+        return v
+
+    def applyPerlinNoise(self, octaves=1, frequency=1, persistence=0.5, amplitude=100, seed=0, tileable=False):
         """ TerrainGenerator.applyPerlinNoise(...)
             - applyPerlinNoise() method generates a heightmap with perlin noise and applies it on top of
             the current heightmap. If used to generate the initial heightmap, TerrainGenerator.initialize()
             must be called first.
+            - The noise is evaluated with fractalNoise() over blocks of rows at once. Equal seeds give
+            equal terrains, in any process.
+            - If tileable is True the noise repeats over the terrain, so that opposite edges match.
+            This requires frequency to be a whole number of noise cycles over the terrain width.
+            - For terrains placed into a world, frequency and tiling refer to the whole world.
         """
         width = self.width*self.cPatchSize
-        height = self.height*self.cPatchSize
-        frequency = float(frequency) / float(width)
-        
-        for y in range(height):
-            for x in range(width):
-                noise = pnoise2(x * frequency, y * frequency, octaves, persistence)
-                self.d_array[x][y] += noise*amplitude
-                
-    def applyPertubation(self, frequency=32.0, displacement=32.0):
+        worldwidth, worldheight = self.__worldSize()
+        frequency = float(frequency) / float(worldwidth)
+        repeatx = repeaty = None
+        if tileable == True:
+            repeatx = int(round(frequency*worldwidth))
+            repeaty = int(round(frequency*worldheight))
+
+        params = (frequency, octaves, persistence, amplitude, seed, repeatx, repeaty, self.worldOrigin)
+        if self.__isParallel():
+            self.__runParallel("noise", params)
+        else:
+            self.__noiseRows(self.__heights(), 0, width, params)
+        self.minvalid = False
+        self.maxvalid = False
+
+    def __noiseRows(self, v, start, stop, params):
+        """ TerrainGenerator.__noiseRows(v, start, stop, params)
+            - Adds the noise of applyPerlinNoise() to rows start..stop of table v.
+            Return value: None
+        """
+        frequency, octaves, persistence, amplitude, seed, repeatx, repeaty, origin = params
+        y = (numpy.arange(v.shape[1]) + origin[1]) * frequency
+        for first, last in self.__rowBlocks(stop-start, v.shape[1]):
+            x = (numpy.arange(start+first, start+last)[:, None] + origin[0]) * frequency
+            noise = self.fractalNoise(x, y[None, :], octaves, persistence, seed=seed, repeatx=repeatx, repeaty=repeaty)
+            v[start+first:start+last] += noise*amplitude
+
+    def fractalNoise(self, x, y, octaves=1, persistence=0.5, lacunarity=2.0, seed=0, repeatx=None, repeaty=None):
+        """ TerrainGenerator.fractalNoise(x, y, octaves, persistence, lacunarity, seed, repeatx, repeaty)
+            - fractalNoise() evaluates fractal brownian motion of 2-dimensional gradient noise at
+              every x,y coordinate pair. x and y are arrays (or anything broadcastable together).
+            - Each octave multiplies the frequency by lacunarity and the amplitude by persistence,
+              and the sum is normalized by the total amplitude, as with noise.pnoise2().
+            - seed selects the permutation table. The table only depends on the seed, hence
+              terrains or tiles generated in separate processes line up exactly.
+            - repeatx and repeaty, if given, make the noise periodic with the given whole number
+              of lattice cells in each direction.
+            Return value: array of noise values, roughly in range [-1, 1]
+        """
+        x = numpy.asarray(x, dtype=float)
+        y = numpy.asarray(y, dtype=float)
+        perm = self.__permutationTable(seed)
+        total = 0.0
+        amplitude = 1.0
+        maxamplitude = 0.0
+        frequency = 1.0
+        for octave in range(octaves):
+            rx = ry = None
+            if repeatx != None: rx = int(round(repeatx*frequency))
+            if repeaty != None: ry = int(round(repeaty*frequency))
+            total = total + self.__gradientNoise(x*frequency, y*frequency, perm, rx, ry) * amplitude
+            maxamplitude += amplitude
+            frequency *= lacunarity
+            amplitude *= persistence
+        return total / maxamplitude
+
+    def applyPertubation(self, frequency=32.0, displacement=32.0, seed=0, interpolation="nearest"):
+        """ TerrainGenerator.applyPertubation(frequency, displacement, seed, interpolation)
+            - applyPertubation() warps the terrain domain. Two noise fields, computed with
+              fractalNoise(), displace each node by up to displacement nodes in X and Y, and the
+              node takes the height found at the displaced location.
+            - Displaced locations outside the terrain are clamped to its border. interpolation
+              "nearest" picks the height of the truncated location and "bilinear" interpolates
+              between the four surrounding nodes.
+            - The warped terrain is gathered into a scratch table of the terrain size, which is
+              swapped with d_array and kept for the next call.
+            - For terrains placed into a world, the noise is evaluated at world coordinates.
+            Return value: True if success, False if parameters are invalid
+        """
+        if interpolation not in ("nearest", "bilinear"):
+            self.printerror("applyPertubation(): unknown interpolation " + str(interpolation))
+            return False
         width = self.width*self.cPatchSize
         height = self.height*self.cPatchSize
-        frequency = float(frequency) / float(width)
-        
-        tmp = numpy.zeros([width*self.cPatchSize+1,height*self.cPatchSize+1], dtype=float)
-        
-        for i in range(width):
-            for j in range(height):
-                u = i + int(pnoise2(j * frequency, i * frequency, 1) * displacement)
-                v = j + int(pnoise2(j * frequency, i * frequency, 2) * displacement)
-                if u < 0: u = 0
-                if v < 0: v = 0
-                if u >= width: u = width - 1
-                if v >= height: v = height - 1
-                tmp[i][j] = self.d_array[u][v]
-        self.d_array = tmp
-        
-    def applyErosion(self, smoothness=16.0):
+        frequency = float(frequency) / float(self.__worldSize()[0])
+        originx, originy = self.worldOrigin
+
+        if self.s_array is None or self.s_array.shape != self.d_array.shape:
+            self.s_array = self.__allocate(self.d_array.shape)
+        src = self.d_array
+        dst = self.s_array
+        dst[width:, :] = src[width:, :]
+        dst[:, height:] = src[:, height:]
+        j = numpy.arange(height)
+        for start, stop in self.__rowBlocks(width, height):
+            i = numpy.arange(start, stop)[:, None]
+            x, y = (j + originy) * frequency, (i + originx) * frequency
+            u = i + self.fractalNoise(x, y, 1, seed=seed) * displacement
+            v = j + self.fractalNoise(x, y, 2, seed=seed+1) * displacement
+            if interpolation == "nearest":
+                u = numpy.clip(u.astype(numpy.int64), 0, width-1)
+                v = numpy.clip(v.astype(numpy.int64), 0, height-1)
+                dst[start:stop, :height] = src[u, v]
+            else:
+                u = numpy.clip(u, 0, width-1)
+                v = numpy.clip(v, 0, height-1)
+                u0 = numpy.minimum(u.astype(numpy.int64), max(width-2, 0))
+                v0 = numpy.minimum(v.astype(numpy.int64), max(height-2, 0))
+                fu = u - u0
+                fv = v - v0
+                dst[start:stop, :height] = (src[u0, v0]*(1.0-fu) + src[u0+1, v0]*fu)*(1.0-fv) + \
+                                           (src[u0, v0+1]*(1.0-fu) + src[u0+1, v0+1]*fu)*fv
+        self.d_array = dst
+        self.s_array = src
+        self.minvalid = False
+        self.maxvalid = False
+        return True
+
+    def applyErosion(self, smoothness=16.0, iterations=1, mode="flatten", tolerance=0.0):
+        """ TerrainGenerator.applyErosion(smoothness, iterations, mode, tolerance)
+            - applyErosion() moves material from each inner node towards its eight neighbours. The
+              slopes to the neighbours are computed with shifted views of the whole terrain and the
+              moved material is scatter-added to the neighbours, so every node of an iteration
+              sees the same input regardless of scan order.
+            - The talus threshold is smoothness/width, or smoothness per world width for world
+              tiles. In mode "flatten" half of the height difference to the steepest lower
+              neighbour is moved, if the slope does not exceed the talus. This smooths plains
+              while keeping cliffs. In mode "thermal" slopes above the talus collapse: half of the
+              excess over the talus is moved, shared between all neighbours steeper than the talus
+              in proportion to their slope.
+            - At most iterations iterations are run. The loop ends early once no node moves more
+              than tolerance material.
+            - Disk-backed terrains are eroded tile by tile and parallel terrains in bands of rows,
+              with a halo wider than the reach of all iterations. With a tolerance, tiles and bands
+              may stop at different iterations.
+            Return value: True if success, False if parameters are invalid
+        """
+        if mode not in ("flatten", "thermal"):
+            self.printerror("applyErosion(): unknown mode " + str(mode))
+            return False
+        talus = float(smoothness) / float(self.__worldSize()[0])
+        if self.__isParallel():
+            self.__runParallel("erosion", (talus, iterations, mode, tolerance), 2*iterations+1)
+        elif self.__isTiled():
+            # What a node receives depends on the other neighbours of the sender, so the
+            # influence of an iteration reaches two samples
+            self.__forEachTile(lambda window, origin: self.__erodeTable(window, talus, iterations, mode, tolerance),
+                               2*iterations+1)
+        else:
+            self.__erodeTable(self.__heights(), talus, iterations, mode, tolerance)
+        self.minvalid = False
+        self.maxvalid = False
+        return True
+
+    def __erodeTable(self, h, talus, iterations, mode, tolerance):
+        """ TerrainGenerator.__erodeTable(h, talus, iterations, mode, tolerance)
+            - Runs the erosion iterations of applyErosion() in place on table h.
+            Return value: the eroded table h
+        """
+        width, height = h.shape
+        if width < 3 or height < 3:
+            return h
+        if h.dtype != numpy.float64:
+            # Iterate in double precision and round into the table once
+            h[...] = self.__erodeTable(numpy.array(h, dtype=numpy.float64), talus, iterations, mode, tolerance)
+            return h
+        directions = [(u, v) for u in range(-1, 2) for v in range(-1, 2) if (u, v) != (0, 0)]
+        center = h[1:-1, 1:-1]
+        neighbours = [h[1+u:width-1+u, 1+v:height-1+v] for u, v in directions]
+        shape = center.shape
+        steepest = numpy.empty(shape)
+        total = numpy.empty(shape)
+        moved = numpy.empty(shape)
+        share = numpy.empty(shape)
+        slopes = [numpy.empty(shape) for k in directions]
+        for iteration in range(iterations):
+            steepest.fill(0.0)
+            total.fill(0.0)
+            for k in range(len(directions)):
+                numpy.subtract(center, neighbours[k], out=slopes[k])
+                numpy.maximum(steepest, slopes[k], out=steepest)
+                if mode == "thermal":
+                    numpy.copyto(share, slopes[k])
+                    share[share <= talus] = 0.0
+                    total += share
+            if mode == "flatten":
+                numpy.multiply(steepest, 0.5, out=moved)
+                moved[(steepest <= 0.0) | (steepest > talus)] = 0.0
+            else:
+                numpy.subtract(steepest, talus, out=moved)
+                numpy.maximum(moved, 0.0, out=moved)
+                moved *= 0.5
+                total[total == 0.0] = 1.0
+            if moved.max() <= tolerance:
+                break
+
+            center -= moved
+            taken = numpy.zeros(shape, dtype=bool)
+            for k in range(len(directions)):
+                if mode == "flatten":
+                    # Material goes to the first steepest neighbour only
+                    receiver = (slopes[k] == steepest) & ~taken
+                    taken |= receiver
+                    numpy.multiply(moved, receiver, out=share)
+                else:
+                    numpy.copyto(share, slopes[k])
+                    share[share <= talus] = 0.0
+                    share /= total
+                    share *= moved
+                neighbours[k] += share
+        return h
+
+    def applyHydraulicErosion(self, droplets=10000, batchsize=4096, seed=0, maxsteps=64, inertia=0.05,
+                              capacity=4.0, mincapacity=0.01, erosion=0.3, deposition=0.3, evaporation=0.02,
+                              gravity=4.0, verbose=False):
+        """ TerrainGenerator.applyHydraulicErosion(droplets, batchsize, seed, ...)
+            - applyHydraulicErosion() simulates rain droplets which run downhill, pick up sediment
+              where they accelerate and drop it where they slow down or evaporate. This carves
+              rivers and gullies into the terrain.
+            - Droplets are simulated batchsize at a time as arrays. Each step samples the height
+              and gradient bilinearly at every droplet, and the eroded or deposited material is
+              scatter-added to the four nodes around the droplet. Droplets of a batch which meet
+              at a node in the same step share the material of one droplet, so that large batches
+              do not dig pits into the old heights.
+            - droplets is the total droplet budget and seed makes the droplet start positions
+              reproducible. maxsteps limits the lifetime of a droplet. inertia, capacity,
+              mincapacity, erosion, deposition, evaporation and gravity tune the droplet physics.
+            - If verbose is True, the achieved throughput is printed.
+            Return value: throughput in droplets per second
+        """
         width = self.width*self.cPatchSize
         height = self.height*self.cPatchSize
-        
-        for i in range(1, width-1):
-            for j in range(1, height-1):
-                max = 0.0
-                match = [0,0]
-                
-                for u in range(-1, 2):
-                    for v in range(-1, 2):
-                        if fabs(u) + fabs(v) > 0:
-                            dI = self.d_array[i][j] - self.d_array[i+u][j+v]
-                            if dI > max:
-                                max = dI
-                                match[0] = u
-                                match[1] = v
-                
-                if max > 0 and max <= float(smoothness) / float(width):
-                    dH = 0.5 * max
-                    self.d_array[i][j] -= dH
-                    self.d_array[i+match[0]][j+match[1]] += dH
-        
+        table = self.__heights()
+        h = self.__doubleTable(table)
+        rng = self.__randomState(seed)
+        start = time.time()
+        remaining = droplets
+        while remaining > 0:
+            n = min(batchsize, remaining)
+            remaining -= n
+            posx = rng.uniform(0, width-1, n)
+            posy = rng.uniform(0, height-1, n)
+            dirx = numpy.zeros(n)
+            diry = numpy.zeros(n)
+            speed = numpy.ones(n)
+            water = numpy.ones(n)
+            sediment = numpy.zeros(n)
+            for step in range(maxsteps):
+                ix = numpy.minimum(posx.astype(numpy.int64), width-2)
+                iy = numpy.minimum(posy.astype(numpy.int64), height-2)
+                fx = posx - ix
+                fy = posy - iy
+                h00 = h[ix, iy]; h10 = h[ix+1, iy]; h01 = h[ix, iy+1]; h11 = h[ix+1, iy+1]
+                gradx = (h10 - h00)*(1.0-fy) + (h11 - h01)*fy
+                grady = (h01 - h00)*(1.0-fx) + (h11 - h10)*fx
+                oldheight = (h00*(1.0-fx) + h10*fx)*(1.0-fy) + (h01*(1.0-fx) + h11*fx)*fy
+
+                dirx = dirx*inertia - gradx*(1.0-inertia)
+                diry = diry*inertia - grady*(1.0-inertia)
+                length = numpy.sqrt(dirx*dirx + diry*diry)
+                moving = length > 0.0
+                dirx[moving] /= length[moving]
+                diry[moving] /= length[moving]
+                posx = posx + dirx
+                posy = posy + diry
+                alive = moving & (posx >= 0) & (posx <= width-1) & (posy >= 0) & (posy <= height-1)
+
+                nx = numpy.clip(posx, 0, width-1)
+                ny = numpy.clip(posy, 0, height-1)
+                jx = numpy.minimum(nx.astype(numpy.int64), width-2)
+                jy = numpy.minimum(ny.astype(numpy.int64), height-2)
+                gx = nx - jx
+                gy = ny - jy
+                newheight = (h[jx, jy]*(1.0-gx) + h[jx+1, jy]*gx)*(1.0-gy) + \
+                            (h[jx, jy+1]*(1.0-gx) + h[jx+1, jy+1]*gx)*gy
+                deltaheight = numpy.where(alive, newheight - oldheight, 0.0)
+
+                limit = numpy.maximum(-deltaheight*speed*water*capacity, mincapacity)
+                depositing = (sediment > limit) | (deltaheight > 0) | ~alive
+                amount = numpy.where(deltaheight > 0, numpy.minimum(deltaheight, sediment),
+                                     (sediment - limit)*deposition)
+                amount = numpy.where(alive, amount, sediment)
+                amount = numpy.where(depositing, amount,
+                                     -numpy.minimum((limit - sediment)*erosion, -deltaheight))
+                parts = numpy.concatenate((amount*(1.0-fx)*(1.0-fy), amount*fx*(1.0-fy),
+                                           amount*(1.0-fx)*fy, amount*fx*fy))
+                cells, index = numpy.unique(numpy.concatenate((ix, ix+1, ix, ix+1))*height +
+                                            numpy.concatenate((iy, iy, iy+1, iy+1)), return_inverse=True)
+                parts = self.__limitOverlap(parts, index, len(cells))
+                sediment = sediment - parts.reshape(4, -1).sum(axis=0)
+                h[cells // height, cells % height] += numpy.bincount(index, weights=parts, minlength=len(cells))
+
+                speed = numpy.sqrt(numpy.maximum(speed*speed + deltaheight*gravity, 0.0))
+                water = water*(1.0-evaporation)
+                if alive.all() == False:
+                    keep = numpy.nonzero(alive)[0]
+                    if len(keep) == 0: break
+                    posx = posx[keep]; posy = posy[keep]; dirx = dirx[keep]; diry = diry[keep]
+                    speed = speed[keep]; water = water[keep]; sediment = sediment[keep]
+            else:
+                # Droplets which run out of steps drop their load where they are
+                ix = numpy.minimum(posx.astype(numpy.int64), width-2)
+                iy = numpy.minimum(posy.astype(numpy.int64), height-2)
+                numpy.add.at(h, (ix, iy), sediment)
+        if h is not table:
+            self.__copyRows(table, h)
+            del h
+        self.minvalid = False
+        self.maxvalid = False
+
+        elapsed = max(time.time() - start, 1e-9)
+        rate = droplets / elapsed
+        if verbose == True:
+            self.printmessage("Hydraulic erosion: %d droplets in %.2f s, %.0f droplets/s" % (droplets, elapsed, rate))
+        return rate
+
+    def __limitOverlap(self, parts, index, count):
+        """ TerrainGenerator.__limitOverlap(parts, index, count)
+            - Limits the material which the droplets of a batch move at the same node in one step.
+              All of them see the same old heights, so without a limit droplets meeting at a node
+              would each erode or fill it by the full local height difference. The erosion and
+              the deposition at each node are scaled down to the largest single one of them.
+              Droplets keep the sediment which they could not drop.
+            - parts are the signed amounts, and index tells the node of each, out of count nodes.
+            Return value: limited parts
+        """
+        limited = numpy.zeros(len(parts))
+        # Every node occurs in index, so each run of the sorted index is one node
+        order = numpy.argsort(index, kind="mergesort")
+        starts = numpy.flatnonzero(numpy.diff(index[order], prepend=-1))
+        for sign in (1.0, -1.0):
+            moved = numpy.maximum(parts*sign, 0.0)
+            total = numpy.bincount(index, weights=moved, minlength=count)
+            largest = numpy.maximum.reduceat(moved[order], starts)
+            scale = numpy.where(total > largest, largest / numpy.maximum(total, 1e-300), 1.0)
+            limited += sign*moved*scale[index]
+        return limited
 
 #############################################################################
 # Terrain helper methods
 #
 
     def __sizeIsPowerOfTwo(self, size):
-        sizeispoweroftwo = False
-        for i in (1, 2, 4, 8, 16, 32, 64, 128):
-            if size == i: return True
-        if sizeispoweroftwo == False:
-            self.printerror("Size is not a power of Two or exceed 128")
-            return False
+        if size > 0 and (size & (size-1)) == 0:
+            return True
+        self.printerror("Size is not a power of Two")
+        return False
+
+    def __randomState(self, rng):
+        """ TerrainGenerator.__randomState(rng)
+            - Turns an integer seed (or None) into a numpy.random.RandomState. RandomState and
+              numpy.random.Generator instances are passed through as such.
+            Return value: random number generator
+        """
+        if rng is None or isinstance(rng, (int, long, numpy.integer)):
+            return numpy.random.RandomState(rng)
+        return rng
+
+    def __randomIntegers(self, rng, low, high, shape):
+        """ TerrainGenerator.__randomIntegers(rng, low, high, shape)
+            - Draws an array of integers from the inclusive range [low, high] with either
+              a RandomState or a Generator.
+            Return value: integer array of given shape
+        """
+        if hasattr(rng, "integers"):
+            return rng.integers(low, high+1, size=shape)
+        return rng.randint(low, high+1, size=shape)
+
+    def __detectNTFByteorder(self, header, filesize):
+        """ TerrainGenerator.__detectNTFByteorder(header, filesize)
+            - Returns the byteorder whose width,height pair in the 8 byte header matches the
+              size of the file. Little-endian is preferred when both would match.
+            Return value: "<", ">" or None if the header matches neither
+        """
+        if len(header) != 8:
+            return None
+        for byteorder in ("<", ">"):
+            width, height = numpy.frombuffer(header, dtype=byteorder+"u4")
+            if 8 + int(width)*int(height)*self.cPatchSize*self.cPatchSize*4 == filesize:
+                return byteorder
+        return None
+
+    def __patchesToTable(self, patches):
+        """ TerrainGenerator.__patchesToTable(patches)
+            - Converts a (width, height, cPatchSize, cPatchSize) patch array, as stored in NTF
+              files, into a 2-dimensional (width*cPatchSize, height*cPatchSize) table.
+            Return value: the table
+        """
+        w, h = patches.shape[0], patches.shape[1]
+        return patches.transpose(0, 2, 1, 3).reshape(w*self.cPatchSize, h*self.cPatchSize)
+
+    def __tableToPatches(self, table):
+        """ TerrainGenerator.__tableToPatches(table)
+            - Inverse of __patchesToTable(). Table dimensions must be multiples of cPatchSize.
+            Return value: (width, height, cPatchSize, cPatchSize) patch array
+        """
+        w = table.shape[0] // self.cPatchSize
+        h = table.shape[1] // self.cPatchSize
+        return table.reshape(w, self.cPatchSize, h, self.cPatchSize).transpose(0, 2, 1, 3)
 
     def getMinitem(self):
         """ TerrainGenerator.getMinitem()
             - getMinitem() is a helper method which will seek the current minimum value from
               the terrain vector. Its purpose is to act as a helper method for the actual algorithms
             - the actual value is cached and invalidated when seen fit. This is to speed up
-              algorithms which take a heavy use of this method.
+              algorithms which take a heavy use of this method. Algorithms which can cheaply
+              tell the new minimum keep the cache valid.
             Return value: float representing the minvalue of the current terrain vector
         """
         if self.minvalid == True:
             return self.minitem
-        self.minitem = 10000
-        for i in range(self.width*self.cPatchSize):
-            for j in range(self.height*self.cPatchSize):
-                if self.d_array[i][j] < self.minitem:
-                    self.minitem = self.d_array[i][j]
+        if self.l_array is not None:
+            self.__pendingExtremes()
+            return self.minitem
+        self.minitem = float(self.__view().min())
         self.minvalid = True
         return self.minitem
 
@@ -579,33 +1909,553 @@ class TerrainGenerator():
             - getMaxitem() is a helper method which will seek the current maximum value from
               the terrain vector. Its purpose is to act as a helper method for the actual algorithms
             - the actual value is cached and invalidated when seen fit. This is to speed up
-              algorithms which take a heavy use of this method.
+              algorithms which take a heavy use of this method. Algorithms which can cheaply
+              tell the new maximum keep the cache valid.
             Return value: float representing the maxvalue of the current terrain vector
         """
         if self.maxvalid == True:
             return self.maxitem
-        self.maxitem = -10000
-        for i in range(self.width*self.cPatchSize):
-            for j in range(self.height*self.cPatchSize):
-                if self.d_array[i][j] > self.maxitem:
-                    self.maxitem = self.d_array[i][j]
+        if self.l_array is not None:
+            self.__pendingExtremes()
+            return self.maxitem
+        self.maxitem = float(self.__view().max())
         self.maxvalid = True
         return self.maxitem
 
+    def __pendingExtremes(self):
+        """ TerrainGenerator.__pendingExtremes()
+            - Finds the extremes of a lazy terrain without running the pending manipulators on the
+              table. All of them are monotonic, so running them on the extremes of the table gives
+              the extremes of the result, and the fused pass still rounds only once.
+            Return value: None
+        """
+        table = self.l_array[:self.width*self.cPatchSize, :self.height*self.cPatchSize]
+        extremes = numpy.array([table.min(), table.max()], dtype=numpy.float64)
+        for name, args in self.pending:
+            self.__elementwise(extremes, name, args)
+        self.minitem, self.maxitem = float(extremes.min()), float(extremes.max())
+        self.minvalid = True
+        self.maxvalid = True
+
+    def __boxFilter1D(self, src, dst, axis, radius, edge, origin, scratch):
+        """ TerrainGenerator.__boxFilter1D(src, dst, axis, radius, edge, origin, scratch)
+            - Box filters src along axis into dst. The terrain is split into blocks of 2*radius+1
+              nodes, counted from the terrain edge, and each block is summed cumulatively from
+              both ends. A window covers the end of one block and the start of the next, so its
+              sum is a suffix sum plus a prefix sum. The sum reads no node outside the window,
+              and bands and tiles of the terrain add exactly the same numbers as the whole one.
+            - origin is the position of src along axis in the terrain. scratch holds three caller
+              allocated buffers of whole blocks, with room for n+2*radius nodes and one extra
+              block, where n is the length of the filtered axis.
+            Return value: None
+        """
+        if axis == 1:
+            src = src.T
+            dst = dst.T
+        n = src.shape[0]
+        r = radius
+        k = 2*r+1
+        data, prefix, suffix = scratch
+        front = (origin-r) % k
+        data[:front] = 0.0
+        data[front+n+2*r:] = 0.0
+        pad = data[front:front+n+2*r]
+        pad[r:r+n] = src
+        if edge == "edge":
+            pad[:r] = src[0]
+            pad[r+n:] = src[n-1]
+        elif edge == "reflect":
+            pad[:r] = src[1:r+1][::-1]
+            pad[r+n:] = src[n-r-1:n-1][::-1]
+        else:
+            pad[:r] = src[n-r:]
+            pad[r+n:] = src[:r]
+        shape = (data.shape[0]//k, k, data.shape[1])
+        numpy.cumsum(data.reshape(shape), axis=1, out=prefix.reshape(shape))
+        numpy.cumsum(data.reshape(shape)[:, ::-1], axis=1, out=suffix.reshape(shape)[:, ::-1])
+        # A window which starts a block covers that block only
+        prefix.reshape(shape)[:, k-1] = 0.0
+        numpy.add(suffix[front:front+n], prefix[front+2*r:front+2*r+n], out=dst)
+        numpy.multiply(dst, 1.0/k, out=dst)
+
+    def __gaussianBoxRadius(self, sigma):
+        """ TerrainGenerator.__gaussianBoxRadius(sigma)
+            - Three box filters of radius r have the variance of r*(r+1). Returns the radius whose
+              three box passes approximate a gaussian of the given deviation best.
+            Return value: integer radius
+        """
+        return max(1, int(round((sqrt(4.0*sigma*sigma+1.0)-1.0)/2.0)))
+
+    def __permutationTable(self, seed):
+        """ TerrainGenerator.__permutationTable(seed)
+            - Returns the doubled 512 entry permutation table of the gradient noise. The table is
+              shuffled with numpy's Mersenne Twister, whose sequence is fixed for a given seed.
+            Return value: integer array
+        """
+        perm = numpy.random.RandomState(seed).permutation(256)
+        return numpy.concatenate((perm, perm))
+
+    def __gradientNoise(self, x, y, perm, repeatx=None, repeaty=None):
+        """ TerrainGenerator.__gradientNoise(x, y, perm, repeatx, repeaty)
+            - Vectorized 2-dimensional improved Perlin noise. Lattice corners are hashed through the
+              permutation table into one of eight gradient directions, and the corner gradients are
+              blended with the quintic fade curve.
+            Return value: array of noise values
+        """
+        x, y = numpy.broadcast_arrays(x, y)
+        x0 = numpy.floor(x)
+        y0 = numpy.floor(y)
+        fx = x - x0
+        fy = y - y0
+        x0 = x0.astype(numpy.int64)
+        y0 = y0.astype(numpy.int64)
+        x1 = x0 + 1
+        y1 = y0 + 1
+        if repeatx != None:
+            x0 %= repeatx
+            x1 %= repeatx
+        if repeaty != None:
+            y0 %= repeaty
+            y1 %= repeaty
+        x0 &= 255; x1 &= 255; y0 &= 255; y1 &= 255
+        px0 = perm[x0]
+        px1 = perm[x1]
+        n00 = self.__gradientDot(perm[px0 + y0], fx, fy)
+        n10 = self.__gradientDot(perm[px1 + y0], fx - 1.0, fy)
+        n01 = self.__gradientDot(perm[px0 + y1], fx, fy - 1.0)
+        n11 = self.__gradientDot(perm[px1 + y1], fx - 1.0, fy - 1.0)
+        u = fx*fx*fx*(fx*(fx*6.0 - 15.0) + 10.0)
+        v = fy*fy*fy*(fy*(fy*6.0 - 15.0) + 10.0)
+        nx0 = n00 + u*(n10 - n00)
+        nx1 = n01 + u*(n11 - n01)
+        return nx0 + v*(nx1 - nx0)
+
+    def __gradientDot(self, hashes, dx, dy):
+        """ TerrainGenerator.__gradientDot(hashes, dx, dy)
+            - Dot product of the offset dx,dy and the gradient selected by the hash. The gradients
+              are the four axis directions and the four diagonals.
+            Return value: array of dot products
+        """
+        gx = numpy.array([1.0, -1.0, 1.0, -1.0, 1.0, -1.0, 0.0, 0.0])[hashes & 7]
+        gy = numpy.array([1.0, 1.0, -1.0, -1.0, 0.0, 0.0, 1.0, -1.0])[hashes & 7]
+        return gx*dx + gy*dy
+
+    def __rowBlocks(self, rows, columns, elements=1<<20):
+        """ TerrainGenerator.__rowBlocks(rows, columns, elements)
+            - Splits rows into consecutive blocks of about the given number of elements, which
+              keeps the temporaries of block-wise vectorized algorithms bounded.
+            Return value: list of (start, stop) row ranges
+        """
+        step = max(1, elements // max(1, columns))
+        return [(start, min(start+step, rows)) for start in range(0, rows, step)]
+
+    def __allocate(self, shape, dtype=None, tiled=None):
+        """ TerrainGenerator.__allocate(shape, dtype, tiled)
+            - Allocates a zeroed float table for the terrain. Tables above tiledThreshold samples,
+              or any table if tiled is True, are memory maps of a temporary file, which is removed
+              from the directory right away and freed when the table is.
+            - dtype defaults to self.dtype. tiled overrides the choice for scratch tables, which
+              should follow the terrain table.
+            Return value: 2-dimensional float array
+        """
+        if dtype == None: dtype = self.dtype
+        if tiled == None: tiled = self.tiled
+        if tiled == False or (tiled == None and shape[0]*shape[1] <= self.tiledThreshold):
+            return numpy.zeros(shape, dtype=dtype)
+        fd, name = tempfile.mkstemp(prefix="terrain", suffix=".tiles", dir=self.tiledir)
+        os.close(fd)
+        table = numpy.memmap(name, dtype=dtype, mode="w+", shape=tuple(shape))
+        try: os.remove(name)
+        except OSError: pass
+        return table
+
+    def __doubleTable(self, table):
+        """ TerrainGenerator.__doubleTable(table)
+            - Returns table itself if it is float64, otherwise a float64 copy of it made in blocks
+              of rows. The copy is disk-backed if the terrain is, so that algorithms can work in
+              double precision without loading a disk-backed terrain into memory.
+            Return value: float64 table
+        """
+        if table.dtype == numpy.float64:
+            return table
+        double = self.__allocate(table.shape, numpy.float64, self.__isTiled())
+        self.__copyRows(double, table)
+        return double
+
+    def __copyRows(self, dst, src):
+        """ TerrainGenerator.__copyRows(dst, src)
+            - Copies table src into dst in blocks of rows, converting the type on the way.
+            Return value: None
+        """
+        for start, stop in self.__rowBlocks(src.shape[0], src.shape[1]):
+            dst[start:stop] = src[start:stop]
+
+    def __isTiled(self):
+        """ TerrainGenerator.__isTiled()
+            Return value: True if the terrain table is disk-backed
+        """
+        return isinstance(self.d_array, numpy.memmap)
+
+    def __forEachTile(self, operator, halo, wrap=False):
+        """ TerrainGenerator.__forEachTile(operator, halo, wrap)
+            - Runs operator over the disk-backed terrain one tile at a time. Each tile is copied into
+              memory with halo extra samples around it, operator(window, origin) returns the
+              processed window, origin being the position of the window in the terrain, and the tile part of it is written into a new disk-backed table, which
+              replaces d_array when all tiles are done. Reading always the original table keeps
+              the tiles independent of each other.
+            - Windows are cut at the terrain borders, so that operator handles the borders as it
+              does for the whole terrain. If wrap is True, the terrain is periodic instead and the
+              halo beyond a border is taken from the opposite side.
+            - self.tileHalo overrides the halo, if set.
+            Return value: None
+        """
+        if self.tileHalo != None:
+            halo = self.tileHalo
+        width = self.width*self.cPatchSize
+        height = self.height*self.cPatchSize
+        src = self.d_array
+        dst = self.__allocate(src.shape)
+        dst[width:, :] = src[width:, :]
+        dst[:, height:] = src[:, height:]
+        for i0 in range(0, width, self.tilesize):
+            i1 = min(i0+self.tilesize, width)
+            for j0 in range(0, height, self.tilesize):
+                j1 = min(j0+self.tilesize, height)
+                if wrap == False:
+                    a0 = max(i0-halo, 0); a1 = min(i1+halo, width)
+                    b0 = max(j0-halo, 0); b1 = min(j1+halo, height)
+                    window = numpy.array(src[a0:a1, b0:b1])
+                else:
+                    a0 = i0-halo; b0 = j0-halo
+                    rows = numpy.arange(i0-halo, i1+halo) % width
+                    cols = numpy.arange(j0-halo, j1+halo) % height
+                    window = numpy.array(src[rows[:, None], cols[None, :]])
+                window = operator(window, (a0, b0))
+                dst[i0:i1, j0:j1] = window[i0-a0:i1-a0, j0-b0:j1-b0]
+        self.d_array = dst
+        self.s_array = None
+
+    def __applyElementwise(self, name, args):
+        """ TerrainGenerator.__applyElementwise(name, args)
+            - Records one of the elementwise manipulators for compute(), which runs it over the
+              terrain right away unless the terrain is lazy. d_array is moved to l_array until then.
+            - The cached extremes go through the same steps as every other node, so they stay
+              equal to the extremes of the table. compute() rounds them like the table.
+            Return value: None
+        """
+        extremes = numpy.array([self.minitem, self.maxitem], dtype=numpy.float64)
+        self.__elementwise(extremes, name, args)
+        self.minitem, self.maxitem = float(extremes[0]), float(extremes[1])
+        if self.minvalid == True and self.maxvalid == True and self.minitem > self.maxitem:
+            self.minitem, self.maxitem = self.maxitem, self.minitem
+        if self.l_array is None:
+            self.l_array = self.d_array
+            del self.d_array
+        self.pending.append((name, args))
+        if self.lazy == False:
+            self.compute()
+
+    def compute(self):
+        """ TerrainGenerator.compute()
+            - compute() runs the elementwise manipulators recorded in lazy mode. All of them are
+              applied to one block of rows at a time, which is small enough to stay in the cache,
+              so the terrain is read and written only once. Reading the heights or running any
+              other algorithm calls compute() implicitly.
+            Return value: True always
+        """
+        if self.l_array is None:
+            return True
+        operations = self.pending
+        self.d_array = self.l_array
+        self.l_array = None
+        self.pending = []
+        if self.__isParallel():
+            self.__runParallel("elementwise", operations)
+        else:
+            self.__fuseElementwise(self.__heights(), operations)
+        if self.dtype != numpy.float64:
+            self.minitem = float(self.dtype.type(self.minitem))
+            self.maxitem = float(self.dtype.type(self.maxitem))
+        return True
+
+    def close(self):
+        """ TerrainGenerator.close()
+            - close() stops the worker processes of the pool used with processes above 1. A later
+              algorithm starts a new pool if needed. Calling it when no pool is running is harmless.
+            Return value: True always
+        """
+        pool = self.__dict__.get("r_pool")
+        if pool != None:
+            self.r_pool = None
+            self.r_tables = []
+            pool.terminate()
+            pool.join()
+        return True
+
+    def __fuseElementwise(self, v, operations):
+        """ TerrainGenerator.__fuseElementwise(v, operations)
+            - Applies a list of (name, args) elementwise manipulators in place on table v, running
+              all of them on each cache sized block of rows before moving to the next block.
+            Return value: None
+        """
+        double = (v.dtype == numpy.float64)
+        for start, stop in self.__rowBlocks(v.shape[0], v.shape[1], 1<<15):
+            # Tables of other types are computed in double precision and rounded once
+            if double == True:
+                block = v[start:stop]
+            else:
+                block = numpy.array(v[start:stop], dtype=numpy.float64)
+            for name, args in operations:
+                self.__elementwise(block, name, args)
+            if double == False:
+                v[start:stop] = block
+
+    def __elementwise(self, v, name, args):
+        """ TerrainGenerator.__elementwise(v, name, args)
+            - Applies the named elementwise manipulator in place on table v, without temporaries.
+            Return value: None
+        """
+        if name == "rescale":
+            minitem, scale, span, minlimit = args
+            numpy.subtract(v, minitem, out=v)
+            numpy.multiply(v, scale, out=v)
+            numpy.true_divide(v, span, out=v)
+            numpy.add(v, minlimit, out=v)
+        elif name == "adjust":
+            numpy.add(v, args[0], out=v)
+        elif name == "quantize":
+            minitem, threshold = args
+            numpy.subtract(v, minitem, out=v)
+            numpy.true_divide(v, threshold, out=v)
+            numpy.floor(v, out=v)
+            numpy.multiply(v, threshold, out=v)
+            numpy.add(v, minitem, out=v)
+        elif name == "saturate":
+            if args[0] > 0: numpy.minimum(v, args[0], out=v)
+            else: numpy.maximum(v, args[0], out=v)
+
+    def __isParallel(self):
+        """ TerrainGenerator.__isParallel()
+            Return value: True if algorithms run in a process pool
+        """
+        return self.processes > 1 and not self.__isTiled()
+
+    def __sharedTable(self, spare=False):
+        """ TerrainGenerator.__sharedTable(spare)
+            - Returns d_array as (RawArray, table) pair in shared memory, moving the terrain there if
+              it is not yet. With spare=True returns instead a second shared table of the same shape,
+              which stencil algorithms write into. The spare is kept for the next algorithm.
+            Return value: (RawArray, table) pair
+        """
+        shape = self.d_array.shape
+        if spare == False:
+            if self.r_shared != None and self.r_shared[1] is self.d_array:
+                return self.r_shared
+            if self.r_spare != None and self.r_spare[1] is self.d_array:
+                self.r_shared, self.r_spare = self.r_spare, self.r_shared
+                return self.r_shared
+            pair = self.__rawTable(shape)
+            pair[1][...] = self.d_array
+            self.d_array = pair[1]
+            self.r_shared = pair
+            return pair
+        if self.r_spare == None or self.r_spare[1].shape != shape:
+            self.r_spare = self.__rawTable(shape)
+        return self.r_spare
+
+    def __rawTable(self, shape):
+        """ TerrainGenerator.__rawTable(shape)
+            - Allocates a float table in shared memory, which worker processes of a pool can map.
+            Return value: (RawArray, table) pair
+        """
+        raw = multiprocessing.RawArray(self.dtype.char, shape[0]*shape[1])
+        return raw, numpy.frombuffer(raw, dtype=self.dtype).reshape(shape)
+
+    def __runParallel(self, operation, params, halo=0, wrap=False):
+        """ TerrainGenerator.__runParallel(operation, params, halo, wrap)
+            - Splits the terrain into one band of rows per process and runs operation on the bands
+              in the process pool. Elementwise operations and noise modify the shared terrain in
+              place. Stencil operations (halo above zero) read their band with halo extra rows
+              from the terrain and write the band into the spare shared table, which then
+              becomes d_array. If wrap is True, the halo beyond the first and last row wraps around.
+            Return value: None
+        """
+        width = self.width*self.cPatchSize
+        height = self.height*self.cPatchSize
+        src = self.__sharedTable()
+        dst = src
+        if halo > 0:
+            dst = self.__sharedTable(spare=True)
+            dst[1][width:, :] = src[1][width:, :]
+            dst[1][:, height:] = src[1][:, height:]
+        pool = self.__pool([src[0], dst[0]])
+        srcindex = [t is src[0] for t in self.r_tables].index(True)
+        dstindex = [t is dst[0] for t in self.r_tables].index(True)
+        step = max(1, -(-width // self.processes))
+        tasks = [(operation, start, min(start+step, width), width, height, halo, wrap, params, srcindex, dstindex)
+                 for start in range(0, width, step)]
+        try:
+            pool.map(_parallelTask, tasks)
+        except:
+            self.close()
+            raise
+        if halo > 0:
+            self.d_array = dst[1]
+            self.r_shared, self.r_spare = dst, src
+
+    def __pool(self, tables):
+        """ TerrainGenerator.__pool(tables)
+            - Returns the process pool of the terrain, starting it if it is not running. The
+              workers map the shared tables when they start, so the pool is started again if
+              tables holds a RawArray the running pool does not know. The shared terrain and its
+              spare are swapped between algorithms, so this happens only when d_array has been
+              replaced or resized.
+            Return value: multiprocessing.Pool
+        """
+        if self.r_pool != None and all(any(t is r for r in self.r_tables) for t in tables):
+            return self.r_pool
+        self.close()
+        shape = self.r_shared[1].shape
+        self.r_tables = [pair[0] for pair in (self.r_shared, self.r_spare) if pair != None and pair[1].shape == shape]
+        self.r_pool = multiprocessing.Pool(self.processes, _parallelInit,
+                                           (self.r_tables, shape, self.dtype.char))
+        return self.r_pool
+
+    def _processBand(self, task, tables):
+        """ TerrainGenerator._processBand(task, tables)
+            - Worker side of __runParallel(). Runs one task on the shared tables of the pool.
+            Return value: None
+        """
+        operation, start, stop, width, height, halo, wrap, params, srcindex, dstindex = task
+        src = tables[srcindex][:width, :height]
+        if operation == "elementwise":
+            self.__fuseElementwise(src[start:stop], params)
+            return
+        if operation == "noise":
+            self.__noiseRows(src, start, stop, params)
+            return
+        if wrap == False:
+            a0 = max(start-halo, 0)
+            window = numpy.array(src[a0:min(stop+halo, width)])
+        else:
+            a0 = start-halo
+            window = numpy.array(src[numpy.arange(start-halo, stop+halo) % width])
+        if operation == "smoothen":
+            b0 = 0
+            if wrap == True:
+                b0 = -halo
+                window = window[:, numpy.arange(-halo, height+halo) % height]
+            self.__smoothenTable(window, params[0], params[1], params[2], (a0, b0))
+            tables[dstindex][start:stop, :height] = window[start-a0:stop-a0, -b0:height-b0]
+            return
+        if operation == "erosion":
+            self.__erodeTable(window, params[0], params[1], params[2], params[3])
+        tables[dstindex][start:stop, :height] = window[start-a0:stop-a0]
+
+    def __heights(self):
+        """ TerrainGenerator.__heights()
+            - Returns a view of d_array without the extra row and column reserved for diamondsquare.
+              Algorithms modify the terrain in place through this view.
+            Return value: 2-dimensional float array view
+        """
+        return self.d_array[:self.width*self.cPatchSize, :self.height*self.cPatchSize]
+
+    def __view(self):
+        """ TerrainGenerator.__view()
+            - Returns the terrain heights for reading. Unlike __heights(), this does not materialize
+              the pending view of crop() and mirror(), so it must not be written to.
+            Return value: 2-dimensional float array, possibly read-only
+        """
+        if self.v_array is not None:
+            return self.v_array
+        return self.__heights()
+
+    def __setView(self, view, width, height):
+        """ TerrainGenerator.__setView(view, width, height)
+            - Replaces the terrain with a read-only view of width*height patches. d_array is dropped
+              and materialized again from the view by __getattr__() when needed.
+        """
+        view = view.view()
+        view.flags.writeable = False
+        self.v_array = view
+        if "d_array" in self.__dict__:
+            del self.d_array
+        self.width = width
+        self.height = height
+
+    def __isMapped(self):
+        """ TerrainGenerator.__isMapped()
+            Return value: True if the terrain is read from the NTF file map, without a d_array
+        """
+        return "d_array" not in self.__dict__ and self.v_array is None and self.l_array is None and self.p_array is not None
+
     def getHeight(self, x, y):
         """ TerrainGenerator.getHeight(x, y)
             - getHeight() returns the current height value from requested node.
             - input taken as x,y coordinate pair to the 2-dimensional terrain vector.
+            - For memory-mapped terrains the value is read directly from the file map. The extra
+              row and column of the table are not in the file, and read as zero like they would
+              from the loaded table. The same holds for the pending view of crop() and mirror().
             Return value: True if successful, otherwise False
         """
-        return self.d_array[x][y]
+        if self.__isMapped() or self.v_array is not None:
+            if x == self.width*self.cPatchSize or y == self.height*self.cPatchSize:
+                if x <= self.width*self.cPatchSize and y <= self.height*self.cPatchSize:
+                    return 0.0
+            if self.v_array is not None:
+                return float(self.v_array[x][y])
+            return float(self.p_array[x//self.cPatchSize, y//self.cPatchSize, x%self.cPatchSize, y%self.cPatchSize])
+        return float(self.d_array[x][y])
+
+    def getPatch(self, i, j):
+        """ TerrainGenerator.getPatch(i, j)
+            - getPatch() returns the cPatchSize*cPatchSize heights of patch i,j. For memory-mapped
+              terrains only the pages holding the patch are read from the file.
+            Return value: 2-dimensional float array
+        """
+        if self.__isMapped():
+            return numpy.array(self.p_array[i, j], dtype=float)
+        return self.__view()[i*self.cPatchSize:(i+1)*self.cPatchSize, j*self.cPatchSize:(j+1)*self.cPatchSize].copy()
+
+    def setPatch(self, i, j, values):
+        """ TerrainGenerator.setPatch(i, j, values)
+            - setPatch() replaces the heights of patch i,j with a cPatchSize*cPatchSize array.
+              Writable memory-mapped terrains are edited in place, use flush() to commit.
+            Return value: True if success, False if the map is read-only
+        """
+        if self.__isMapped():
+            if self.p_array.flags.writeable == False:
+                self.printerror("setPatch() on a read-only memory-mapped terrain.")
+                return False
+            self.p_array[i, j] = values
+        else:
+            self.d_array[i*self.cPatchSize:(i+1)*self.cPatchSize, j*self.cPatchSize:(j+1)*self.cPatchSize] = values
+        self.minvalid = False
+        self.maxvalid = False
+        return True
+
+    def __heightBands(self, heights, limit1, limit2, variance, rng):
+        """ TerrainGenerator.__heightBands(heights, limit1, limit2, variance, rng)
+            - Vectorized height_to_rgb() for a table of heights. The jittered thresholds are drawn
+              for blocks of rows at a time from rng.
+            Return value: (rows, columns, 3) uint8 array of weights, R for the lowest band
+        """
+        weights = numpy.zeros(heights.shape + (3,), dtype=numpy.uint8)
+        for start, stop in self.__rowBlocks(heights.shape[0], heights.shape[1]):
+            h = heights[start:stop]
+            low = h < self.__randomIntegers(rng, int(limit1-variance), int(limit1+variance), h.shape)
+            middle = ~low & (h < self.__randomIntegers(rng, int(limit2-variance), int(limit2+variance), h.shape))
+            weights[start:stop, :, 0] = low * 255
+            weights[start:stop, :, 1] = middle * 255
+            weights[start:stop, :, 2] = ~(low | middle) * 255
+        return weights
 
     def height_to_rgb(self, height, limit1=0.5, limit2=35.0, variance=2):
         """ TerrainGenerator.height_to_rgb(maxitem, height)
             - height_to_rgb() translates given height value into RGB value with certain thresholds
             - the implementation of this method is merely a test without proper intelligence. Only
               purpose primarily is to test mapping of terrain shape into terrain surface textures.
-            - will be rewritten soon..
+            - computeWeights() offers rule based texturing by height, slope and curvature.
             Return value: translated R, G and B values
         """
         if height < float(random.randint(int(limit1-variance), int(limit1+variance))):
@@ -622,6 +2472,8 @@ class TerrainGenerator():
               and the given rectangle for cropping will fit inside the current terrain.
             - offsetX and offsetY define the top left coordinate from where the crop will start
               and patchesX,patchesY pair define the number of full patches to be extracted.
+            - No heights are copied. The terrain becomes a view into the old table, which is copied
+              only when an algorithm modifies the terrain, so chains of crop() and mirror() are cheap.
             Return value: True if success, False if failure
         """
 
@@ -634,45 +2486,77 @@ class TerrainGenerator():
         if (offsetY + patchesY*self.cPatchSize > self.height*self.cPatchSize):
             return False
 
-        # Next, allocate the new table:
-        newTable = numpy.zeros([patchesX*self.cPatchSize, patchesY*self.cPatchSize], dtype=float)
-        for x in range(patchesX*self.cPatchSize):
-            for y in range(patchesY*self.cPatchSize):
-                newTable[x][y] = self.d_array[offsetX+x][offsetY+y];
-
-        # Finally override the old variables
-        self.d_array = newTable
-        self.width = patchesX
-        self.height = patchesY
+        view = self.__view()[offsetX:offsetX+patchesX*self.cPatchSize, offsetY:offsetY+patchesY*self.cPatchSize]
+        self.__setView(view, patchesX, patchesY)
+        self.minvalid = False
+        self.maxvalid = False
         return True
 
     def mirror(self, mirrorX=True, mirrorY=False):
         """ TerrainGenerator.mirror(mirrorX, mirrorY)
+            - Mirrors the terrain along the x and/or y axis. Like crop(), this only creates a view
+              with negative strides, and the heights are copied when the terrain is modified.
             Return value: always True
         """
 
         #self.printmessage("Mirroring terrain data mirrorX=%s, mirrorY=%s" % (mirrorX, mirrorY))
 
+        view = self.__view()
         if mirrorX == True:
-            # Allocate the new table:
-            newTable = numpy.zeros([self.width*self.cPatchSize, self.height*self.cPatchSize], dtype=float)
-            for x in range(self.width*self.cPatchSize):
-                for y in range(self.height*self.cPatchSize):
-                    newTable[x][y] = self.d_array[self.width*self.cPatchSize-1-x][y];
-            # Override the old variables
-            self.d_array = newTable
-
+            view = view[::-1, :]
         if mirrorY == True:
-            # Allocate the new table:
-            newTable = numpy.zeros([self.width*self.cPatchSize, self.height*self.cPatchSize], dtype=float)
-            for x in range(self.width*self.cPatchSize):
-                for y in range(self.height*self.cPatchSize):
-                    newTable[x][y] = self.d_array[x][self.height*self.cPatchSize-1-y];
-            # Override the old variables
-            self.d_array = newTable
-
+            view = view[:, ::-1]
+        if mirrorX == True or mirrorY == True:
+            self.__setView(view, self.width, self.height)
         return True
 
+#############################################################################
+# Worker functions for process pools. These need to be module level functions
+# so that they can be pickled.
+#
+
+def _readMosaicTile(job):
+    """ _readMosaicTile(job)
+        - Reads one ASC tile for TerrainGenerator.fromMosaic() and returns the part of it which
+          falls inside the mosaic. job is (filename, ncols, nrows, col, row, cols, rows), where
+          col,row is the position of the tile in the cols*rows mosaic.
+        Return value: (c0, c1, r0, r1, heights, nodata) or None if reading failed
+    """
+    filename, ncols, nrows, col, row, cols, rows = job
+    t = TerrainGenerator()
+    if t.fromFile(filename, fill="zero") == False:
+        return None
+    c0 = max(col, 0); c1 = min(col+ncols, cols)
+    r0 = max(row, 0); r1 = min(row+nrows, rows)
+    heights = numpy.array(t.d_array[c0-col:c1-col, r0-row:r1-row], dtype=numpy.float32)
+    if t.m_array is None:
+        nodata = numpy.zeros(heights.shape, dtype=bool)
+    else:
+        nodata = t.m_array[c0-col:c1-col, r0-row:r1-row].copy()
+    return c0, c1, r0, r1, heights, nodata
+
+_sharedTables = []
+
+def _worldTileTask(job):
+    """ _worldTileTask(job)
+        - Generates one tile of TerrainGenerator.toWorldTiles() in a pool worker.
+    """
+    return TerrainGenerator(0, 0, dtype=job[9])._generateWorldTile(job)
+
+def _parallelInit(tables, shape, dtype):
+    """ _parallelInit(tables, shape, dtype)
+        - Pool initializer of TerrainGenerator.__runParallel(). Maps the shared RawArrays of the
+          terrain as tables of the given shape and dtype.
+    """
+    global _sharedTables
+    _sharedTables = [numpy.frombuffer(table, dtype=dtype).reshape(shape) for table in tables]
+
+def _parallelTask(task):
+    """ _parallelTask(task)
+        - Runs one band task of TerrainGenerator.__runParallel() in a pool worker.
+    """
+    TerrainGenerator(0, 0)._processBand(task, _sharedTables)
+
 #############################################################################
 
 if __name__ == "__main__":
@@ -712,4 +2596,46 @@ if __name__ == "__main__":
     terrain.toFile("./resources/terrain5.ntf", overwrite=True)
     terrain.toWeightmap("./resources/terrainweights2.tga", fileformat="TGA", overwrite=True)
 
+    print "Running float32 accuracy check against float64 tables"
+    checks = [("diamond-square", False, lambda t: t.fromDiamondsquare(4, 10, -5, -5, 10, rng=1)),
+              ("rescale, saturate, quantize", False, lambda t: (t.rescale(-20, 50), t.saturate(-5), t.quantize(8))),
+              ("perlin noise", False, lambda t: (t.initialize(8, 8), t.applyPerlinNoise(4, 8.0, 0.5, 50, seed=2))),
+              ("adjust, rescale, quantize lazy", True, lambda t: (t.adjustHeight(0.3), t.rescale(-2.5, 3.7), t.quantize(13))),
+              ("adjust, rescale, quantize", False, lambda t: (t.adjustHeight(0.3), t.rescale(-2.5, 3.7), t.quantize(13))),
+              ("smoothen", False, lambda t: t.smoothen(3, 2, kernel="gaussian")),
+              ("erosion", False, lambda t: t.applyErosion(16.0, 4, mode="thermal")),
+              ("hydraulic erosion", False, lambda t: t.applyHydraulicErosion(2000, seed=3)),
+              ("pertubation", False, lambda t: t.applyPertubation(16.0, 8.0, seed=4, interpolation="bilinear"))]
+    for name, lazy, check in checks:
+        outputs = []
+        for dtype in (numpy.float64, numpy.float32):
+            # Both types start from the same float32 heights, as if read from an NTF file
+            t = TerrainGenerator(dtype=dtype, lazy=lazy)
+            if name != checks[0][0]:
+                t.fromFile("./resources/accuracy.ntf")
+            check(t)
+            t.toFile("./resources/accuracy_%s.ntf" % numpy.dtype(dtype).name, overwrite=True)
+            data = open("./resources/accuracy_%s.ntf" % numpy.dtype(dtype).name, "rb").read()
+            outputs.append(numpy.frombuffer(data[8:], dtype="<f4"))
+        if lazy == False:
+            os.rename("./resources/accuracy_float64.ntf", "./resources/accuracy.ntf")
+        else:
+            os.remove("./resources/accuracy_float64.ntf")
+        os.remove("./resources/accuracy_float32.ntf")
+        differs = numpy.count_nonzero(outputs[0] != outputs[1])
+        if differs == 0:
+            print "  %-32s identical" % name
+        else:
+            print "  %-32s %d samples differ, by up to %g" % (name, differs, abs(outputs[0] - outputs[1]).max())
+    os.remove("./resources/accuracy.ntf")
+
+    print "Running hydraulic erosion range check"
+    for batchsize in (4096, 64):
+        t = TerrainGenerator(8, 8)
+        t.applyPerlinNoise(6, 4, seed=1)
+        minitem, maxitem = t.getMinitem(), t.getMaxitem()
+        t.applyHydraulicErosion(20000, batchsize=batchsize, seed=0)
+        print "  batchsize %-5d stays within %.2f..%.2f: %s" % \
+            (batchsize, minitem, maxitem, minitem <= t.getMinitem() and t.getMaxitem() <= maxitem)
+
     print "Done!"
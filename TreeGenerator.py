@@ -73,10 +73,10 @@ class TreeGenerator():
         print "Generating trees..."
         
         for tile, tileName in enumerate(self.terrainSlice):
-            #read height data from generated .ntf files
+            #read height data from generated .ntf files, mapped so that only sampled patches are loaded
             inputFile = self.outputFolder + tileName + ".ntf"
             t = TerrainGenerator.TerrainGenerator()
-            t.fromFile(inputFile)
+            t.fromFile(inputFile, mapped=True)
             
             coordGeneral = self.generateCoordGrid(t, tile)
             vegCoord = []
@@ -2,6 +2,7 @@ OTHER_FILES += \
     WorldGenerator.py \
     TextureGenerator.py \
     TerrainGenerator.py \
+    TerrainCache.py \
     README \
     license.txt \
     TXMLOutput.py \